@@ -0,0 +1,199 @@
+"""
+Бенчмарк обработки почты без Exchange и боевого FTP: синтетические письма отдает FakeEmailHandler,
+файлы загружаются на локальный сервер pyftpdlib. Измеряются FileProcessor, FTPUploader
+и полный проход main.main(); для каждого прогона сохраняются метрики этапов (modules.metrics).
+
+Результаты пишутся в JSON (по умолчанию benchmarks/results/<коммит>.json), чтобы сравнивать
+производительность между коммитами: --compare <файл> выводит отношение к прошлому результату.
+
+Зависимости: pip install -r requirements-bench.txt
+Запуск: python -m benchmarks.bench_pipeline [--messages 20] [--attachments 3] [--formats jpeg,png,tiff]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger  # noqa: E402
+
+from benchmarks.fakes import FORMATS, FakeEmailHandler, LocalFTPServer, make_messages  # noqa: E402
+from modules.content_store import ContentStore  # noqa: E402
+from modules.file_processor import FileProcessor  # noqa: E402
+from modules.ftp_uploader import FTPUploader  # noqa: E402
+from modules.image_converter import ImageConverter  # noqa: E402
+from modules.metrics import metrics  # noqa: E402
+from modules.text_processor import TextProcessor  # noqa: E402
+from modules.transfer_journal import TransferJournal  # noqa: E402
+from modules.work_ledger import WorkLedger  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+REMOTE_DIR = '/bench'
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS_DIR), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def make_uploader(server, work_dir, args):
+    return FTPUploader(server.host, server.username, server.password, port=server.port,
+                       pool_size=args.parallel, journal=TransferJournal(os.path.join(work_dir, 'transfers.sqlite3')))
+
+
+def run_measured(function):
+    """
+    Выполняет функцию на чистом реестре метрик.
+    :return: Кортеж (результат функции, время в секундах, сводка метрик этапов).
+    """
+    metrics.reset()
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    return result, elapsed, metrics.summary()
+
+
+def report(name, elapsed, items, size, summary, **extra):
+    result = {'seconds': round(elapsed, 4),
+              'items': items,
+              'items_per_second': round(items / elapsed, 2) if elapsed else None,
+              'megabytes_per_second': round(size / elapsed / 1024 ** 2, 2) if elapsed else None,
+              'stages': summary['stages'],
+              'bytes': summary['bytes'],
+              'counters': summary['counters']}
+    result.update(extra)
+    print(f"{name:<16} {elapsed:8.2f} с  {result['items_per_second']:8.1f} шт/с  "
+          f"{result['megabytes_per_second']:8.1f} МБ/с")
+    for stage, stats in sorted(summary['stages'].items()):
+        print(f"    {stage:<20} {stats['count']:6d} × {stats['mean'] * 1000:8.2f} мс  (макс. {stats['max'] * 1000:.1f} мс)")
+    return result
+
+
+def bench_file_processor(messages, work_dir, args):
+    attachments = [(attachment.name, attachment.content) for message in messages for attachment in message.attachments]
+    output_dir = os.path.join(work_dir, 'processed')
+    processor = FileProcessor(converter=ImageConverter(workers=args.workers))
+    try:
+        paths, elapsed, summary = run_measured(
+            lambda: list(processor.process_images(attachments, output_dir, 'Подпись к фото', 'Бенчмарк')))
+    finally:
+        processor.close()
+    size = sum(len(content) for _, content in attachments)
+    return report('FileProcessor', elapsed, len(paths), size, summary), paths
+
+
+def bench_ftp_uploader(server, paths, work_dir, args):
+    os.makedirs(os.path.join(server.root, REMOTE_DIR.lstrip('/')), exist_ok=True)
+    uploader = make_uploader(server, work_dir, args)
+    try:
+        results, elapsed, summary = run_measured(
+            lambda: uploader.upload_files(paths, REMOTE_DIR, parallel=args.parallel))
+    finally:
+        uploader.disconnect()
+    uploaded = [result for result in results if result['success']]
+    return report('FTPUploader', elapsed, len(uploaded), sum(result['bytes'] for result in uploaded), summary,
+                  logins=uploader.login_count, session_reuses=uploader.reuse_count)
+
+
+def bench_end_to_end(server, messages, work_dir, args):
+    """
+    Полный проход main.main(): обработчики из create_handlers заменяются локальными.
+    """
+    import main
+
+    download_dir = os.path.join(work_dir, 'downloads')
+    os.makedirs(os.path.join(server.root, main.UPLOAD_REMOTE_DIR.lstrip('/')), exist_ok=True)
+    email_handler = FakeEmailHandler(messages, latency=args.ews_latency / 1000)
+
+    def create_handlers():
+        return (email_handler,
+                FileProcessor(converter=ImageConverter(workers=args.workers)),
+                TextProcessor(),
+                make_uploader(server, work_dir, args),
+                ContentStore(os.path.join(work_dir, 'content.sqlite3')),
+                WorkLedger(os.path.join(work_dir, 'ledger.sqlite3')))
+
+    main.create_handlers = create_handlers
+    main.DOWNLOAD_DIR = download_dir
+    main.METRICS_PROMETHEUS_PATH = main.METRICS_SUMMARY_PATH = None
+    _, elapsed, summary = run_measured(main.main)
+
+    size = sum(attachment.size for message in messages for attachment in message.attachments)
+    return report('main.main()', elapsed, len(messages), size, summary, ews_requests=email_handler.requests)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding='utf-8') as file:
+        baseline = json.load(file)
+    print(f"\nСравнение с {baseline_path} ({baseline.get('commit')}):")
+    for name, result in results['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or not previous.get('seconds'):
+            continue
+        print(f"    {name:<16} {previous['seconds']:8.2f} с -> {result['seconds']:8.2f} с  "
+              f"({previous['seconds'] / result['seconds']:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20, help="Число писем")
+    parser.add_argument('--attachments', type=int, default=3, help="Вложений в письме")
+    parser.add_argument('--formats', default='jpeg,png,tiff', help="Форматы вложений через запятую")
+    parser.add_argument('--width', type=int, default=1600, help="Ширина изображений в пикселях")
+    parser.add_argument('--height', type=int, default=1200, help="Высота изображений в пикселях")
+    parser.add_argument('--workers', type=int, default=None, help="Процессы конвертации (по умолчанию — по числу ядер)")
+    parser.add_argument('--parallel', type=int, default=4, help="Параллельные загрузки на FTP")
+    parser.add_argument('--ews-latency', type=float, default=0, help="Имитация задержки Exchange на запрос, мс")
+    parser.add_argument('--output', help="Файл результатов (по умолчанию benchmarks/results/<коммит>.json)")
+    parser.add_argument('--compare', help="Файл прошлых результатов для сравнения")
+    args = parser.parse_args()
+
+    formats = [image_format.strip() for image_format in args.formats.split(',') if image_format.strip()]
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        parser.error(f"Неизвестные форматы: {', '.join(sorted(unknown))}")
+
+    logger.remove()
+    print(f"Подготовка {args.messages} писем по {args.attachments} вложения ({', '.join(formats)}, "
+          f"{args.width}x{args.height})...")
+    messages = make_messages(args.messages, args.attachments, formats, args.width, args.height)
+
+    work_dir = tempfile.mkdtemp(prefix='efp_bench_')
+    ftp_root = os.path.join(work_dir, 'ftp')
+    os.makedirs(ftp_root)
+    results = {'commit': git_revision(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'params': vars(args),
+               'results': {}}
+    try:
+        with LocalFTPServer(ftp_root) as server:
+            results['results']['file_processor'], paths = bench_file_processor(messages, work_dir, args)
+            results['results']['ftp_uploader'] = bench_ftp_uploader(server, paths, work_dir, args)
+            results['results']['end_to_end'] = bench_end_to_end(server, messages, work_dir, args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Бенчмарк запуска для коротких прогонов по cron: время импорта main в отдельном процессе,
+самые медленные модули по -X importtime и пустой проход почтового ящика (писем нет).
+Для пустого прохода проверяется, какие тяжелые библиотеки оказались загружены:
+при ленивых импортах их быть не должно.
+
+Результаты пишутся в JSON (по умолчанию benchmarks/results/startup_<коммит>.json).
+
+Запуск: python -m benchmarks.bench_startup [--runs 5] [--top 15]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.bench_pipeline import RESULTS_DIR, git_revision  # noqa: E402
+
+# Библиотеки, которые не нужны, пока нет писем с вложениями
+HEAVY_MODULES = ('PIL', 'exchangelib', 'lxml', 'exiftool', 'bs4', 'http.server')
+
+
+def measure_import(runs):
+    """
+    Время `python -c "import main"` в новом процессе (минимум из нескольких запусков).
+    """
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import main'], cwd=ROOT_DIR, check=True)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def import_profile(top):
+    """
+    Разбирает вывод -X importtime: самые медленные модули по суммарному времени (с зависимостями).
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=ROOT_DIR,
+                            capture_output=True, text=True, check=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # Формат строки: "import time: <свое, мкс> | <суммарное, мкс> | <модуль>"
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append({'module': name.strip(), 'self_ms': int(own) / 1000, 'cumulative_ms': int(cumulative) / 1000})
+    modules.sort(key=lambda module: module['cumulative_ms'], reverse=True)
+    return modules[:top]
+
+
+def loaded_heavy_modules():
+    return sorted(name for name in HEAVY_MODULES if name in sys.modules)
+
+
+def empty_poll():
+    """
+    Проход main.process_mailbox по пустому ящику (FakeEmailHandler без писем).
+    :return: Кортеж (время в секундах, загруженные тяжелые модули до и после прохода).
+    """
+    started = time.perf_counter()
+    import main
+    from benchmarks.fakes import FakeEmailHandler
+
+    imported = loaded_heavy_modules()
+    main.METRICS_PROMETHEUS_PATH = main.METRICS_SUMMARY_PATH = None
+    # Обработчики файлов и FTP не должны понадобиться: при обращении к ним проход упадет
+    main.process_mailbox(FakeEmailHandler([]), None, None, None)
+    return time.perf_counter() - started, imported, loaded_heavy_modules()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Число запусков для замера импорта")
+    parser.add_argument('--top', type=int, default=15, help="Сколько самых медленных модулей показать")
+    parser.add_argument('--output', help="Файл результатов (по умолчанию benchmarks/results/startup_<коммит>.json)")
+    args = parser.parse_args()
+
+    from loguru import logger
+    logger.remove()
+
+    timings = measure_import(args.runs)
+    print(f"import main: мин. {min(timings) * 1000:.1f} мс, макс. {max(timings) * 1000:.1f} мс "
+          f"({args.runs} запусков, с запуском интерпретатора)")
+
+    modules = import_profile(args.top)
+    print("Самые медленные импорты:")
+    for module in modules:
+        print(f"    {module['module']:<40} {module['cumulative_ms']:8.1f} мс  (сам {module['self_ms']:.1f} мс)")
+
+    elapsed, imported, after_poll = empty_poll()
+    print(f"Пустой проход: {elapsed * 1000:.1f} мс")
+    print(f"    тяжелые модули после импорта: {', '.join(imported) or 'нет'}")
+    print(f"    тяжелые модули после прохода: {', '.join(after_poll) or 'нет'}")
+
+    results = {'commit': git_revision(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'import_seconds': [round(timing, 4) for timing in timings],
+               'import_seconds_min': round(min(timings), 4),
+               'slowest_imports': modules,
+               'empty_poll_seconds': round(elapsed, 4),
+               'heavy_modules_after_import': imported,
+               'heavy_modules_after_poll': after_poll}
+    output = args.output or os.path.join(RESULTS_DIR, f"startup_{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    print(f"Результаты сохранены в {output}")
+
+
+if __name__ == '__main__':
+    main()
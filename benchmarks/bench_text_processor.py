@@ -0,0 +1,97 @@
+"""
+Сравнение скорости извлечения подписи к фото: прежний путь (BeautifulSoup + поочередный поиск шаблонов)
+и текущий TextProcessor (потоковый парсер lxml + одно объединенное регулярное выражение).
+
+Запуск: python -m benchmarks.bench_text_processor [--replies 200] [--repeat 5]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+from loguru import logger  # noqa: E402
+
+from modules.text_processor import TextProcessor  # noqa: E402
+
+STYLE = '<style>' + ''.join(f'.c{i} {{ color: #{i:06x}; margin: {i}px; }}\n' for i in range(500)) + '</style>'
+BODY = ('<p>Добрый день, коллеги!</p>'
+        '<p>Фото: пресс-служба Администрации губернатора Санкт-Петербурга</p>'
+        '<p>Подписать можно: Прямая линия с губернатором Санкт-Петербурга Александром Бегловым</p>'
+        '<p>С уважением,<br>Аня</p>')
+
+
+def make_thread_html(replies):
+    """
+    Собирает HTML длинной пересланной переписки: собственный текст и replies вложенных цитат.
+    """
+    quoted = ''
+    for index in range(replies):
+        quoted = (f'<div id="divRplyFwdMsg"><b>From:</b> sender{index}@example.com<br><b>Sent:</b> 2024-11-30</div>'
+                  f'<blockquote><p>Сообщение {index}. ' + 'Текст предыдущего письма. ' * 40 + f'</p>{quoted}</blockquote>')
+    return f'<html><head>{STYLE}</head><body>{BODY}<hr>{quoted}</body></html>'
+
+
+def legacy_extract(html, processor):
+    """
+    Прежняя реализация: дерево BeautifulSoup, проверка каждой строки всеми шаблонами приветствий
+    и re.split по каждому шаблону подписи.
+    """
+    email_text = BeautifulSoup(html, 'html.parser').get_text().strip()
+    greetings = [re.compile(pattern, re.IGNORECASE) for pattern in processor.GREETINGS]
+    signatures = [re.compile(pattern, re.IGNORECASE) for pattern in processor.SIGNATURES]
+
+    cleaned_lines = []
+    greeting_removed = False
+    for line in email_text.splitlines():
+        if not greeting_removed and any(pattern.match(line.strip()) for pattern in greetings):
+            greeting_removed = True
+            continue
+        cleaned_lines.append(line)
+
+    cleaned_text = "\n".join(cleaned_lines)
+    for pattern in signatures:
+        cleaned_text = re.split(pattern, cleaned_text, maxsplit=1)[0]
+    return cleaned_text.strip()
+
+
+def current_extract(html, processor):
+    return processor.extract_clean_text(processor.html_to_text(html))
+
+
+def measure(function, html, processor, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(html, processor)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--replies', type=int, default=200, help="Число писем в пересланной цепочке")
+    parser.add_argument('--repeat', type=int, default=5, help="Число повторов (берется лучшее время)")
+    args = parser.parse_args()
+
+    logger.remove()
+    processor = TextProcessor()
+    html = make_thread_html(args.replies)
+    print(f"Размер HTML: {len(html) / 1024:.0f} КБ, писем в цепочке: {args.replies}")
+
+    legacy_time, legacy_text = measure(legacy_extract, html, processor, args.repeat)
+    current_time, current_text = measure(current_extract, html, processor, args.repeat)
+
+    print(f"Прежний путь (BeautifulSoup):  {legacy_time * 1000:8.1f} мс")
+    print(f"TextProcessor (lxml, 1 regex): {current_time * 1000:8.1f} мс")
+    print(f"Ускорение: {legacy_time / current_time:.1f}x")
+    # Прежний get_text() склеивал абзацы в одну строку, поэтому приветствие могло «съесть» весь текст
+    print(f"Подпись (прежний путь): {legacy_text[:80]!r}")
+    print(f"Подпись (TextProcessor): {current_text[:80]!r}")
+
+
+if __name__ == '__main__':
+    main()
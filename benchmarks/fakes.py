@@ -0,0 +1,199 @@
+"""
+Локальные заменители внешних систем для бенчмарков: синтетические письма с вложениями,
+обработчик почты вместо Exchange и FTP-сервер pyftpdlib во временной папке.
+"""
+import io
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from modules.metrics import metrics
+
+# Форматы синтетических вложений: расширение файла, формат PIL и MIME-тип
+FORMATS = {
+    'jpeg': ('.jpg', 'JPEG', 'image/jpeg'),
+    'png': ('.png', 'PNG', 'image/png'),
+    'tiff': ('.tif', 'TIFF', 'image/tiff'),
+}
+
+MAIL_BODY = ('<html><head><style>p {{ margin: 0; }}</style></head><body>'
+             '<p>Добрый день, коллеги!</p>'
+             '<p>Фото: пресс-служба, съемка №{index}</p>'
+             '<p>Подписать можно: синтетическое письмо для бенчмарка</p>'
+             '<p>С уважением,<br>Редакция</p></body></html>')
+
+
+class FakeAttachmentId:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeAttachment:
+    def __init__(self, name, content, content_type):
+        self.attachment_id = FakeAttachmentId(f'attachment-{name}')
+        self.name = name
+        self.content = content
+        self.content_type = content_type
+        self.size = len(content)
+
+
+class FakeSender:
+    def __init__(self, email_address):
+        self.email_address = email_address
+
+
+class FakeMessage:
+    def __init__(self, index, attachments):
+        self.id = f'fake-{index}'
+        self.subject = f'Синтетическое письмо {index}'
+        self.sender = FakeSender(f'sender{index % 5}@example.com')
+        self.body = MAIL_BODY.format(index=index)
+        self.attachments = attachments
+        self.is_read = False
+
+
+def make_image(image_format, width, height, seed):
+    """
+    Создает изображение с шумом (сжимается примерно как фотография) в заданном формате.
+    Каждое изображение уникально, чтобы индекс содержимого не пропускал его как повтор.
+    """
+    from PIL import Image
+
+    rng = random.Random(seed)
+    channels = [Image.effect_noise((width, height), rng.randint(20, 60)) for _ in range(3)]
+    image = Image.merge('RGB', channels)
+    _, pil_format, _ = FORMATS[image_format]
+    buffer = io.BytesIO()
+    save_args = {'quality': 92} if pil_format == 'JPEG' else {}
+    image.save(buffer, pil_format, **save_args)
+    return buffer.getvalue()
+
+
+def make_messages(count, attachments_per_message, formats, width, height):
+    """
+    Собирает синтетические письма: форматы вложений чередуются по кругу.
+    :return: Список FakeMessage.
+    """
+    messages = []
+    seed = 0
+    for index in range(count):
+        attachments = []
+        for number in range(attachments_per_message):
+            image_format = formats[seed % len(formats)]
+            ext, _, content_type = FORMATS[image_format]
+            content = make_image(image_format, width, height, seed)
+            attachments.append(FakeAttachment(f'IMG_{index:04d}_{number}{ext}', content, content_type))
+            seed += 1
+        messages.append(FakeMessage(index, attachments))
+    return messages
+
+
+class FakeEmailHandler:
+    """
+    Заменитель EmailHandler: отдает синтетические письма из памяти. Задержка latency (в секундах)
+    имитирует время ответа Exchange на каждый запрос.
+    """
+
+    def __init__(self, messages, latency=0.0):
+        self.messages = messages
+        self.latency = latency
+        self.state = None  # локальное состояние синхронизации не ведется
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def check_mailbox(self, from_addresses=None):
+        with metrics.timer('ews_fetch'):
+            self._request()
+            emails = [message for message in self.messages if not message.is_read]
+        metrics.count('messages_fetched', len(emails))
+        return emails
+
+    sync_mailbox = check_mailbox
+
+    def iter_attachments(self, email, download_dir, max_size=None, memory_limit=16 * 1024 * 1024,
+                         chunk_size=1024 * 1024, skip_ids=()):
+        for attachment in email.attachments:
+            if max_size and attachment.size > max_size or attachment.attachment_id.id in skip_ids:
+                continue
+            with metrics.timer('attachment_download'):
+                self._request()
+                if attachment.size <= memory_limit:
+                    source = attachment.content
+                else:
+                    os.makedirs(download_dir, exist_ok=True)
+                    fd, source = tempfile.mkstemp(dir=download_dir, prefix='.', suffix=f'_{attachment.name}')
+                    with os.fdopen(fd, 'wb') as file:
+                        for offset in range(0, attachment.size, chunk_size):
+                            file.write(attachment.content[offset:offset + chunk_size])
+            metrics.add_bytes('attachment_download', attachment.size)
+            yield attachment.attachment_id.id, attachment.name, source
+
+    def mark_processed(self, email):
+        pass
+
+    def save_protocol(self):
+        pass
+
+    def forget_protocol(self):
+        pass
+
+    def mark_as_read_batch(self, emails):
+        with metrics.timer('ews_mark_read'):
+            self._request()
+            for email in emails:
+                email.is_read = True
+        return list(emails)
+
+    def subscribe(self):
+        pass
+
+    def wait_for_new_mail(self, timeout_minutes=1):
+        return False
+
+    def unsubscribe(self):
+        pass
+
+
+class LocalFTPServer:
+    """
+    FTP-сервер pyftpdlib в фоновом потоке на свободном локальном порту.
+    :param root: Корневая папка пользователя FTP.
+    """
+
+    def __init__(self, root, username='bench', password='bench', host='127.0.0.1'):
+        try:
+            from pyftpdlib.authorizers import DummyAuthorizer
+            from pyftpdlib.handlers import FTPHandler
+            from pyftpdlib.log import config_logging
+            from pyftpdlib.servers import ThreadedFTPServer
+        except ImportError:
+            raise RuntimeError("Для бенчмарков нужен pyftpdlib: pip install -r requirements-bench.txt")
+
+        config_logging(level=logging.WARNING)  # иначе сервер пишет в лог каждую команду
+        self.root = root
+        self.username = username
+        self.password = password
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(username, password, root, perm='elradfmwMT')
+        handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer, 'banner': 'bench'})
+        self._server = ThreadedFTPServer((host, 0), handler)
+        self.host, self.port = self._server.address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'timeout': 0.1},
+                                        name='bench-ftp', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.close_all()
+        self._thread.join(timeout=5)
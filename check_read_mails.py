@@ -19,7 +19,7 @@ def main():
 
     )
 
-    emails = email_handler.get_all_mails()
+    emails = email_handler.get_all_mails(fields=('subject', 'sender', 'body', 'datetime_received'))
 
     for email in emails:
         # if chardet.detect(email.body.encode())['encoding'] != 'utf-8':
@@ -4,3 +4,56 @@
 CHECK_INTERVAL = 300  # Интервал проверки почты (в секундах)
 DOWNLOAD_DIR = './downloads/'  # Папка для сохранения файлов
 # DOWNLOAD_DIR = Path().absolute()/'downloads'  # Папка для сохранения файлов
+
+FTP_POOL_SIZE = 4  # Максимум одновременно открытых FTP-сессий к одному серверу
+FTP_RETRIES = 2  # Повторы загрузки после обрыва FTP-соединения
+FTP_NOOP_INTERVAL = 30  # Простой сессии (в секундах), после которого она проверяется командой NOOP
+FTP_PARALLEL_UPLOADS = 4  # Число параллельных загрузок файлов на FTP
+FTP_CHUNK_SIZE = 1024 * 1024  # Размер блока передачи на FTP (в байтах)
+UPLOAD_BACKEND = 'ftp'  # Хранилище для фотографий: 'ftp', 'ftps', 'sftp' (requirements-sftp.txt) или 'local'
+UPLOAD_REMOTE_DIR = '/PHOTO/INBOX/SHOOTS/BEZ_AVTORA/KSP_018175'  # Каталог по умолчанию для фотографий
+# Правила выбора каталога по отправителю и теме письма (регулярные выражения), срабатывает первое подходящее:
+# [{'sender': r'@tass\.ru$', 'remote_dir': '/PHOTO/INBOX/TASS'}, {'subject': r'спорт', 'remote_dir': '/PHOTO/SPORT'}]
+UPLOAD_ROUTES = []
+UPLOAD_CREATE_DIRS = True  # Создавать отсутствующие каталоги в хранилище
+UPLOAD_LOCAL_ROOT = './upload/'  # Корневая папка хранилища для UPLOAD_BACKEND = 'local'
+SFTP_KNOWN_HOSTS = None  # Файл known_hosts для SFTP (None — ~/.ssh/known_hosts)
+STATE_DIR = './state/'  # Папка для локального состояния (журналы, индексы)
+TRANSFER_JOURNAL_PATH = STATE_DIR + 'transfers.sqlite3'  # Журнал передачи файлов для докачки после сбоя
+MAILBOX_STATE_PATH = STATE_DIR + 'mailbox.sqlite3'  # Checkpoint синхронизации ящика и очередь писем
+CONTENT_INDEX_PATH = STATE_DIR + 'content.sqlite3'  # Индекс вложений по хэшу для пропуска повторов
+CONTENT_STORE_MAX_BYTES = 2 * 1024 ** 3  # Лимит размера обработанных файлов в DOWNLOAD_DIR (вытеснение по LRU)
+CONTENT_STORE_MAX_ENTRIES = 100000  # Лимит числа записей в индексе вложений
+FOLDER_INDEX_PATH = STATE_DIR + 'folders.sqlite3'  # Индекс загруженных файлов локальных папок (mtime, размер, хэш)
+WORK_LEDGER_PATH = STATE_DIR + 'ledger.sqlite3'  # Журнал этапов обработки писем для продолжения после сбоя
+LEDGER_RETRY_BASE = 60  # Пауза перед первым повтором письма с ошибкой (в секундах), дальше удваивается
+LEDGER_RETRY_MAX = 3600  # Максимальная пауза между повторами письма с ошибкой (в секундах)
+LEDGER_RETENTION_DAYS = 30  # Сколько дней хранить в журнале записи о полностью обработанных письмах
+EWS_PAGE_SIZE = 50  # Число писем, запрашиваемых у Exchange за один запрос
+MAILBOX_SYNC = True  # Получать письма инкрементально (SyncFolderItems) вместо фильтра по непрочитанным
+EWS_PROTOCOL_CACHE_PATH = STATE_DIR + 'ews_protocol.json'  # Версия Exchange и тип авторизации между запусками
+
+CONVERSION_WORKERS = None  # Число процессов для конвертации изображений (None — по числу ядер, 0 — без пула)
+JPEG_QUALITY = 90  # Качество JPEG после конвертации (1-95)
+JPEG_SUBSAMPLING = '4:2:0'  # Субдискретизация цвета: '4:4:4', '4:2:2' или '4:2:0'
+JPEG_PROGRESSIVE = False  # Записывать прогрессивный JPEG
+JPEG_OPTIMIZE = True  # Оптимизировать таблицы Хаффмана
+MAX_IMAGE_SIZE = None  # Максимальный размер большей стороны при конвертации (None — без уменьшения)
+CONVERSION_SPLIT_FRAMES = True  # Сохранять страницы многостраничного TIFF отдельными JPEG
+CONVERSION_MEMORY_BUDGET = 2 * 1024 ** 3  # Бюджет памяти одновременных конвертаций в байтах (None — без ограничения)
+
+MAX_ATTACHMENT_SIZE = 100 * 1024 * 1024  # Вложения крупнее (в байтах) не скачиваются
+ATTACHMENT_MEMORY_LIMIT = 16 * 1024 * 1024  # Вложения до этого размера обрабатываются в памяти, крупнее — через диск
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024  # Размер блока при потоковом скачивании вложений
+
+STREAMING_TIMEOUT = 1  # Время удержания streaming-соединения EWS в режиме службы (в минутах)
+DAEMON_BACKOFF_MAX = 600  # Максимальная пауза (в секундах) после повторяющихся ошибок в режиме службы
+
+PIPELINE_DOWNLOAD_WORKERS = 2  # Потоки скачивания вложений
+PIPELINE_PROCESS_WORKERS = 4  # Потоки обработки изображений (конвертация идет в пуле процессов)
+PIPELINE_UPLOAD_WORKERS = FTP_PARALLEL_UPLOADS  # Сколько вложений одновременно загружается в хранилище
+PIPELINE_QUEUE_SIZE = 16  # Емкость очередей между этапами конвейера
+
+METRICS_PROMETHEUS_PATH = STATE_DIR + 'metrics.prom'  # Метрики в текстовом формате Prometheus (None — не писать)
+METRICS_SUMMARY_PATH = STATE_DIR + 'last_run.json'  # JSON-сводка последнего прохода (None — не писать)
+METRICS_HTTP_PORT = None  # Порт HTTP-эндпоинта /metrics в режиме службы (None — выключен)
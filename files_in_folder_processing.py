@@ -1,5 +1,8 @@
+import os
 from pathlib import Path
 
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.tif', '.jpeg', '.tiff')
+
 
 class FilesInFolder():
 
@@ -10,11 +13,43 @@ class FilesInFolder():
         if not my_path.is_dir():
             raise ValueError(f"Path {path_to_folder} is not a valid directory.")
 
-        extensions = ['.jpg', '.png', '.tif', '.jpeg', '.tiff']
-        image_files = [f for f in my_path.glob("*") if f.suffix.lower() in extensions]
+        image_files = [Path(entry.path) for entry in FilesInFolder.iter_files(path_to_folder, recursive=False)]
 
         return image_files
 
+    @staticmethod
+    def iter_files(path_to_folder: str, extensions=IMAGE_EXTENSIONS, recursive=True):
+        """
+        Лениво перебирает файлы-изображения папки через os.scandir: список файлов целиком не строится,
+        а stat берется из записи каталога. Скрытые файлы и папки (начинающиеся с точки) пропускаются,
+        по символическим ссылкам на папки обход не идет.
+        :param path_to_folder: Папка для обхода.
+        :param extensions: Расширения файлов (в нижнем регистре).
+        :param recursive: Обходить вложенные папки.
+        :return: Генератор os.DirEntry.
+        """
+        if not os.path.isdir(path_to_folder):
+            raise ValueError(f"Path {path_to_folder} is not a valid directory.")
+
+        stack = [os.path.abspath(path_to_folder)]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    subdirectories = []
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif entry.name.lower().endswith(extensions) and entry.is_file():
+                            yield entry
+            except OSError:
+                # Папка недоступна (права, удалена во время обхода): пропускаем ее
+                continue
+            if recursive:
+                stack.extend(sorted(subdirectories, reverse=True))
+
 
 if __name__ == '__main__':
 
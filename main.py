@@ -1,94 +1,375 @@
+import argparse
+import itertools
 import os
+import signal
 import sys
+import threading
 import time
 
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from loguru import logger
 
-from config import DOWNLOAD_DIR
+from config import (DOWNLOAD_DIR, FTP_POOL_SIZE, FTP_RETRIES, FTP_NOOP_INTERVAL, FTP_CHUNK_SIZE, UPLOAD_BACKEND,
+                    UPLOAD_REMOTE_DIR, UPLOAD_ROUTES, UPLOAD_CREATE_DIRS, UPLOAD_LOCAL_ROOT, SFTP_KNOWN_HOSTS,
+                    TRANSFER_JOURNAL_PATH, CONVERSION_WORKERS, JPEG_QUALITY, JPEG_SUBSAMPLING,
+                    JPEG_PROGRESSIVE, JPEG_OPTIMIZE, MAX_IMAGE_SIZE, CONVERSION_SPLIT_FRAMES,
+                    CONVERSION_MEMORY_BUDGET, MAX_ATTACHMENT_SIZE, ATTACHMENT_MEMORY_LIMIT,
+                    ATTACHMENT_CHUNK_SIZE, CHECK_INTERVAL, STREAMING_TIMEOUT, DAEMON_BACKOFF_MAX, MAILBOX_STATE_PATH,
+                    MAILBOX_SYNC, EWS_PAGE_SIZE, EWS_PROTOCOL_CACHE_PATH, PIPELINE_DOWNLOAD_WORKERS,
+                    PIPELINE_PROCESS_WORKERS, PIPELINE_UPLOAD_WORKERS, PIPELINE_QUEUE_SIZE, CONTENT_INDEX_PATH,
+                    CONTENT_STORE_MAX_BYTES, CONTENT_STORE_MAX_ENTRIES, FOLDER_INDEX_PATH, METRICS_PROMETHEUS_PATH,
+                    METRICS_SUMMARY_PATH, METRICS_HTTP_PORT, WORK_LEDGER_PATH, LEDGER_RETRY_BASE, LEDGER_RETRY_MAX,
+                    LEDGER_RETENTION_DAYS)
+from modules.content_store import ContentStore
 from modules.email_handler import EmailHandler
 from modules.file_processor import FileProcessor
+from modules.folder_index import FolderIndex
+from modules.folder_ingest import FolderIngest
 from modules.ftp_uploader import FTPUploader
+from modules.image_converter import ImageConverter
+from modules.local_uploader import LocalUploader
+from modules.mailbox_state import MailboxState
+from modules.metrics import metrics, profiling
+from modules.pipeline import MailPipeline
+from modules.sftp_uploader import SFTPUploader
 from modules.text_processor import TextProcessor
+from modules.transfer_journal import TransferJournal
+from modules.upload_router import UploadRouter
+from modules.work_ledger import WorkLedger
 
-# Получаем путь к директории скрипта
-script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
-log_file_path = os.path.join(script_dir, "kommersant_mail.log")
-logger.add(log_file_path, format="{time} {level} {message}", level="INFO", retention="1 day", rotation="1 day")
 
+def setup_logging():
+    """
+    Добавляет файл лога рядом со скриптом.
+    """
+    # Получаем путь к директории скрипта
+    script_dir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    log_file_path = os.path.join(script_dir, "kommersant_mail.log")
+    logger.add(log_file_path, format="{time} {level} {message}", level="INFO", retention="1 day", rotation="1 day")
 
-def main():
-    # Создаем экземпляры обработчиков
-    load_dotenv()
+
+def create_file_processor():
+    return FileProcessor(converter=ImageConverter(
+        workers=CONVERSION_WORKERS,
+        quality=JPEG_QUALITY,
+        subsampling=JPEG_SUBSAMPLING,
+        progressive=JPEG_PROGRESSIVE,
+        optimize=JPEG_OPTIMIZE,
+        max_size=MAX_IMAGE_SIZE,
+        split_frames=CONVERSION_SPLIT_FRAMES,
+        memory_budget=CONVERSION_MEMORY_BUDGET,
+    ))
+
+
+def create_uploader():
+    """
+    Создает хранилище для загрузки файлов по UPLOAD_BACKEND. Адрес и учетные данные
+    FTP, FTPS и SFTP берутся из переменных окружения ftp_host, ftp_port, FTP_LOGIN, FTP_PASS.
+    """
+    if UPLOAD_BACKEND == 'local':
+        return LocalUploader(UPLOAD_LOCAL_ROOT, parallel=FTP_POOL_SIZE, create_dirs=UPLOAD_CREATE_DIRS)
+    if UPLOAD_BACKEND == 'sftp':
+        return SFTPUploader(
+            host=os.environ.get('ftp_host'),
+            username=os.environ.get('FTP_LOGIN'),
+            password=os.environ.get('FTP_PASS'),
+            port=int(os.environ.get('ftp_port', 22)),
+            pool_size=FTP_POOL_SIZE,
+            retries=FTP_RETRIES,
+            known_hosts=SFTP_KNOWN_HOSTS,
+            create_dirs=UPLOAD_CREATE_DIRS,
+        )
+    if UPLOAD_BACKEND not in ('ftp', 'ftps'):
+        raise ValueError(f"Неизвестное хранилище UPLOAD_BACKEND: {UPLOAD_BACKEND}")
+    return FTPUploader(
+        host=os.environ.get('ftp_host'),
+        username=os.environ.get('FTP_LOGIN'),
+        password=os.environ.get('FTP_PASS'),
+        port=int(os.environ.get('ftp_port', 21)),
+        pool_size=FTP_POOL_SIZE,
+        retries=FTP_RETRIES,
+        noop_interval=FTP_NOOP_INTERVAL,
+        journal=TransferJournal(TRANSFER_JOURNAL_PATH),
+        chunk_size=FTP_CHUNK_SIZE,
+        tls=UPLOAD_BACKEND == 'ftps',
+        create_dirs=UPLOAD_CREATE_DIRS,
+    )
 
 
+def create_content_store():
+    return ContentStore(CONTENT_INDEX_PATH, max_bytes=CONTENT_STORE_MAX_BYTES,
+                        max_entries=CONTENT_STORE_MAX_ENTRIES)
+
+
+def create_work_ledger():
+    ledger = WorkLedger(WORK_LEDGER_PATH, retry_base=LEDGER_RETRY_BASE, retry_max=LEDGER_RETRY_MAX)
+    removed = ledger.prune(LEDGER_RETENTION_DAYS * 24 * 3600)
+    if removed:
+        logger.info(f"Из журнала обработки удалено старых писем: {removed}")
+    return ledger
+
+
+def create_handlers():
+    """
+    Создает обработчики почты, файлов, текста и хранилища для загрузки.
+    :return: Кортеж (email_handler, file_processor, text_processor, uploader, content_store, ledger).
+    """
+    load_dotenv()
+
     email_handler = EmailHandler(
         server=os.environ.get('exchange_server'),
         username=os.environ.get('exchange_username'),
         password=os.environ.get('exchange_password'),
         primary_smtp_address=os.environ.get('primary_smtp_address'),
-
+        state=MailboxState(MAILBOX_STATE_PATH) if MAILBOX_SYNC else None,
+        page_size=EWS_PAGE_SIZE,
+        protocol_cache=EWS_PROTOCOL_CACHE_PATH,
     )
-    file_processor = FileProcessor()
+    # Конструкторы ниже ни к чему не подключаются: сессии хранилища, пул конвертации, PIL и exiftool
+    # создаются при первом файле, поэтому пустой проход их не затрагивает
+    file_processor = create_file_processor()
     text_processor = TextProcessor()
-    ftp_uploader = FTPUploader(
-        host=os.environ.get('ftp_host'),
-        username=os.environ.get('FTP_LOGIN'),
-        password=os.environ.get('FTP_PASS'),
-        port=int(os.environ.get('ftp_port', 21))
+    uploader = create_uploader()
+    content_store = create_content_store()
+    ledger = create_work_ledger()
+    return email_handler, file_processor, text_processor, uploader, content_store, ledger
+
+
+def process_mailbox(email_handler, file_processor, text_processor, uploader, content_store=None, ledger=None):
+    """
+    Один проход по новым письмам: обработка вложений, загрузка на FTP, отметка о прочтении.
+    Этапы работают одновременно, письмо отмечается прочитанным только после загрузки всех его файлов.
+    С журналом обработки письмо, прерванное сбоем, продолжается с последнего завершенного этапа.
+    """
+    metrics.count('passes')
+    started = time.perf_counter()
+    emails = email_handler.sync_mailbox() if MAILBOX_SYNC else email_handler.check_mailbox()
+
+    # Первое письмо запрашивается до запуска конвейера: если писем нет, потоки и подключения не создаются
+    emails = iter(emails)
+    first = next(emails, None)
+    email_handler.save_protocol()
+    if first is None:
+        logger.info("Новых писем нет")
+        stats = {'messages': 0}
+        metrics.observe('pass', time.perf_counter() - started)
+        export_metrics(stats)
+        return stats
+
+    pipeline = MailPipeline(
+        email_handler, file_processor, text_processor, uploader,
+        router=UploadRouter(UPLOAD_REMOTE_DIR, UPLOAD_ROUTES),
+        download_dir=DOWNLOAD_DIR,
+        download_workers=PIPELINE_DOWNLOAD_WORKERS,
+        process_workers=PIPELINE_PROCESS_WORKERS,
+        upload_workers=PIPELINE_UPLOAD_WORKERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        ack_batch_size=EWS_PAGE_SIZE,
+        max_attachment_size=MAX_ATTACHMENT_SIZE,
+        memory_limit=ATTACHMENT_MEMORY_LIMIT,
+        chunk_size=ATTACHMENT_CHUNK_SIZE,
+        store=content_store,
+        ledger=ledger,
     )
+    stats = pipeline.run(itertools.chain([first], emails))
+    metrics.observe('pass', time.perf_counter() - started)
+    export_metrics(stats)
+    return stats
+
+
+def export_metrics(stats):
+    """
+    Записывает накопленные метрики в файл Prometheus и JSON-сводку (пути задаются в config.py).
+    :param stats: Статистика последнего прохода конвейера.
+    """
+    try:
+        if METRICS_PROMETHEUS_PATH:
+            metrics.write_prometheus(METRICS_PROMETHEUS_PATH)
+        if METRICS_SUMMARY_PATH:
+            metrics.write_summary(METRICS_SUMMARY_PATH, last_pass=stats)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить метрики: {e}")
+
+
+def close_handlers(email_handler, file_processor, text_processor, uploader, content_store, ledger):
+    email_handler.unsubscribe()
+    uploader.disconnect()
+    file_processor.close()
+    content_store.close()
+    ledger.close()
+    if email_handler.state is not None:
+        email_handler.state.close()
+
+
+def main():
+    # Создаем экземпляры обработчиков
+    handlers = create_handlers()
 
     print("Запуск программы для обработки писем...")
 
-    emails = email_handler.check_mailbox()
+    try:
+        with profiling():
+            process_mailbox(*handlers)
+    except Exception:
+        # Следующий запуск заново определит версию сервера и тип авторизации
+        handlers[0].forget_protocol()
+        raise
+    finally:
+        close_handlers(*handlers)
 
-    for email in emails:
-        logger.info(f"Получено письмо от: {email.sender.email_address}")
-        logger.info(f"Тема: {email.subject}")
+    logger.info(time.strftime("%H:%M:%S", time.localtime()))
 
 
-        # Скачиваем вложения
-        attachments = email_handler.download_attachments(email, DOWNLOAD_DIR)
-        logger.info(f"Скачаны файлы: {attachments}")
+def ingest_folder(folder, remote_dir=UPLOAD_REMOTE_DIR, caption='', subject=None):
+    """
+    Загружает на FTP новые и измененные изображения локальной папки (рекурсивно)
+    тем же путем, что и вложения писем. Подключение к Exchange не нужно.
+    """
+    load_dotenv()
+    file_processor = create_file_processor()
+    uploader = create_uploader()
+    content_store = create_content_store()
+    index = FolderIndex(FOLDER_INDEX_PATH)
 
-        # извлекаю текст из html письма
-        soup = BeautifulSoup(email.body, 'html.parser')
-        email_text =  soup.get_text().strip()
+    print(f"Загрузка папки {folder}...")
+    try:
+        with profiling():
+            ingest = FolderIngest(file_processor, uploader, index, remote_dir=remote_dir, output_dir=DOWNLOAD_DIR,
+                                  process_workers=PIPELINE_PROCESS_WORKERS, upload_workers=PIPELINE_UPLOAD_WORKERS,
+                                  queue_size=PIPELINE_QUEUE_SIZE, store=content_store)
+            stats = ingest.run(folder, caption=caption, subject=subject)
+        export_metrics(stats)
+    finally:
+        uploader.disconnect()
+        file_processor.close()
+        content_store.close()
+        index.close()
+    return stats
 
-        # Извлекаем текст письма и обрабатываем
-        clean_text = text_processor.extract_clean_text(email_text)
-        logger.info(f'{clean_text = }')
 
-        # извлекаем тему письма
-        email_subject = email.subject
+def wait_for_mail(email_handler, stop_event, interval, use_streaming):
+    """
+    Ждет появления новой почты, но не дольше interval секунд.
+    :return: Признак того, что streaming-подписка по-прежнему работает.
+    """
+    if not use_streaming:
+        stop_event.wait(interval)
+        return False
 
-        for file in attachments:
-            logger.info(f'{file = }')
-            # Проверяем, является ли файл изображением
-            if not file_processor.is_image(file):
-                logger.info(f"Загрузка отменена: {file} (не является изображением)")
-                continue
+    deadline = time.monotonic() + interval
+    try:
+        while not stop_event.is_set() and time.monotonic() < deadline:
+            if email_handler.wait_for_new_mail(timeout_minutes=STREAMING_TIMEOUT):
+                logger.info("Получено уведомление о новом письме")
+                break
+        return True
+    except Exception as e:
+        logger.warning(f"Streaming-подписка недоступна ({e}), переход на опрос каждые {interval} с")
+        return False
 
-            #Конвертируем файл в JPEG, если это необходимо
-            processed_file = file_processor.convert_to_jpeg(file)
 
-            # Добавляем XMP-метаданные
-            file_processor.add_xmp_metadata(processed_file, clean_text, email_subject)
+def retry_delay(errors, base):
+    """
+    Экспоненциальная пауза после errors ошибок подряд, не больше DAEMON_BACKOFF_MAX секунд.
+    """
+    return min(DAEMON_BACKOFF_MAX, base * 2 ** (errors - 1))
 
-            # Загружаем файл на FTP
-            ftp_uploader.connect()
-            ftp_uploader.upload_files([processed_file],
-                                      remote_dir="/PHOTO/INBOX/SHOOTS/BEZ_AVTORA/KSP_018175")
 
-        # Отмечаем письмо как прочитанное
-        email_handler.mark_as_read(email)
+def subscribe(email_handler):
+    """
+    Создает streaming-подписку на новые письма.
+    :return: Признак того, что подписка создана.
+    """
+    try:
+        email_handler.subscribe()
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось подписаться на новые письма ({e}), используется опрос")
+        return False
 
 
-    logger.info(time.strftime("%H:%M:%S", time.localtime()))
+def run_daemon(interval=CHECK_INTERVAL):
+    """
+    Режим службы: подключения к Exchange и FTP создаются один раз, новые письма приходят
+    через streaming-подписку EWS (при ее недоступности — опрос каждые interval секунд,
+    а подписка повторяется с экспоненциальной паузой).
+    Ошибки обрабатываются с экспоненциальной паузой, SIGINT/SIGTERM завершают работу после текущего прохода.
+    """
+    stop_event = threading.Event()
 
+    def request_stop(signum, frame):
+        logger.info(f"Получен сигнал {signum}, завершение работы...")
+        stop_event.set()
 
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    handlers = None
+    use_streaming = False
+    streaming_errors = 0
+    streaming_retry_at = 0.0
+    errors = 0
+    print("Запуск программы для обработки писем в режиме службы...")
+    metrics_server = metrics.serve(METRICS_HTTP_PORT) if METRICS_HTTP_PORT else None
+
+    try:
+        while not stop_event.is_set():
+            try:
+                if handlers is None:
+                    handlers = create_handlers()
+                    use_streaming = False
+                    streaming_retry_at = 0.0
+                if not use_streaming and time.monotonic() >= streaming_retry_at:
+                    # Подписываемся до прохода, чтобы не пропустить письма, пришедшие во время обработки
+                    use_streaming = subscribe(handlers[0])
+                    if not use_streaming:
+                        streaming_errors += 1
+                        streaming_retry_at = time.monotonic() + retry_delay(streaming_errors, interval)
+
+                process_mailbox(*handlers)
+                errors = 0
+                logger.info(time.strftime("%H:%M:%S", time.localtime()))
+                streaming = wait_for_mail(handlers[0], stop_event, interval, use_streaming)
+                if streaming:
+                    streaming_errors = 0
+                elif use_streaming:
+                    # Подписка оборвалась: следующий проход идет по опросу, подписка повторяется после паузы
+                    streaming_errors += 1
+                    streaming_retry_at = time.monotonic() + retry_delay(streaming_errors, interval)
+                use_streaming = streaming
+            except Exception as e:
+                errors += 1
+                metrics.count('pass_errors')
+                delay = retry_delay(errors, 2)
+                logger.error(f"Ошибка обработки почты: {e}. Повтор через {delay} с")
+                if errors >= 3 and handlers is not None:
+                    # Несколько ошибок подряд: пересоздаем подключения с нуля
+                    handlers[0].forget_protocol()
+                    close_handlers(*handlers)
+                    handlers = None
+                stop_event.wait(delay)
+    finally:
+        if handlers is not None:
+            close_handlers(*handlers)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        logger.info("Служба остановлена")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Обработка писем с фотографиями и загрузка на FTP")
+    parser.add_argument('--daemon', action='store_true', help="Работать постоянно, ожидая новые письма")
+    parser.add_argument('--folder', help="Загрузить изображения из локальной папки вместо обработки почты")
+    parser.add_argument('--remote-dir', default=UPLOAD_REMOTE_DIR, help="Каталог в хранилище для --folder")
+    parser.add_argument('--caption', default='', help="Подпись к фото для --folder")
+    parser.add_argument('--subject', help="Заголовок описания для --folder (по умолчанию — имя папки файла)")
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.folder:
+        ingest_folder(args.folder, remote_dir=args.remote_dir, caption=args.caption, subject=args.subject)
+    elif args.daemon:
+        with profiling():
+            run_daemon()
+    else:
+        main()
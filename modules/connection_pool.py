@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+
+
+class ConnectionPool:
+    """
+    Небольшой пул долгоживущих подключений к хранилищу с проверкой состояния и переподключением.
+    Как открыть, проверить и закрыть подключение, задают функции, поэтому пул общий для FTP и SFTP.
+    Последним возвращенное подключение выдается первым: оно реже успевает устареть.
+    """
+
+    def __init__(self, connect, is_alive, close, size=2):
+        """
+        :param connect: Открывает новое подключение и возвращает его.
+        :param is_alive: is_alive(подключение, секунды простоя) — можно ли использовать подключение повторно.
+        :param close: Закрывает подключение, не выбрасывая исключений.
+        :param size: Максимальное число одновременных подключений.
+        """
+        self._connect = connect
+        self._is_alive = is_alive
+        self._close = close
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._connections = []
+        self._lock = threading.Lock()
+        self.login_count = 0
+        self.reuse_count = 0
+
+    def _open(self):
+        connection = self._connect()
+        with self._lock:
+            self.login_count += 1
+            self._connections.append(connection)
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+        self._close(connection)
+
+    def acquire(self):
+        """
+        Выдает рабочее подключение из пула, при необходимости подключаясь заново.
+        Ждет, если открыто size подключений и все заняты.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                connection, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                return self._open()
+            if self._is_alive(connection, time.monotonic() - released_at):
+                with self._lock:
+                    self.reuse_count += 1
+                return connection
+            self._discard(connection)
+            return self._open()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def reconnect(self, connection):
+        """
+        Заменяет оборванное подключение новым, не освобождая место в пуле.
+        :return: Новое подключение.
+        """
+        self._discard(connection)
+        return self._open()
+
+    def release(self, connection, broken=False):
+        """
+        Возвращает подключение в пул.
+        :param broken: Подключение неисправно: оно закрывается, а не возвращается.
+        """
+        if broken:
+            self._discard(connection)
+        else:
+            self._idle.put((connection, time.monotonic()))
+        self._slots.release()
+
+    def close_all(self):
+        """
+        Закрывает все подключения пула.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            self._close(connection)
+        while not self._idle.empty():
+            self._idle.get_nowait()
@@ -0,0 +1,222 @@
+import os
+import posixpath
+import threading
+import time
+
+from loguru import logger
+
+from modules.utils import open_sqlite
+
+
+class ContentStore:
+    """
+    Индекс вложений по хэшу содержимого. Позволяет не обрабатывать и не загружать повторно
+    одни и те же фотографии, пришедшие в разных письмах (пересылки, копии коллегам),
+    и выдает уникальные локальные имена файлов. Загрузки учитываются по каталогам хранилища:
+    содержимое, загруженное в один каталог, для другого каталога повтором не считается.
+    Локальные файлы вытесняются по LRU
+    при превышении лимита размера, записи индекса — при превышении лимита числа записей.
+    """
+
+    def __init__(self, db_path, max_bytes=2 * 1024 ** 3, max_entries=100000):
+        """
+        :param db_path: Путь к файлу базы SQLite.
+        :param max_bytes: Лимит суммарного размера обработанных файлов на диске.
+        :param max_entries: Лимит числа записей в индексе.
+        """
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._db = open_sqlite(db_path)
+        tables = {row['name'] for row in self._db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS content (
+                sha256 TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                stem TEXT NOT NULL,
+                local_path TEXT,
+                size INTEGER NOT NULL DEFAULT 0,
+                remote_path TEXT,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS content_stem ON content (stem);
+            CREATE INDEX IF NOT EXISTS content_last_access ON content (last_access);
+            CREATE TABLE IF NOT EXISTS uploads (
+                sha256 TEXT NOT NULL,
+                remote_dir TEXT NOT NULL,
+                remote_path TEXT NOT NULL,
+                PRIMARY KEY (sha256, remote_dir)
+            );
+            CREATE TABLE IF NOT EXISTS frames (
+                sha256 TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                stem TEXT NOT NULL,
+                PRIMARY KEY (sha256, page)
+            );
+            CREATE INDEX IF NOT EXISTS frames_stem ON frames (stem);
+            """
+        )
+        if 'content' in tables and 'uploads' not in tables:
+            # Индекс прежней версии хранил одну загрузку на содержимое в content.remote_path
+            rows = self._db.execute('SELECT sha256, remote_path FROM content WHERE remote_path IS NOT NULL').fetchall()
+            self._db.executemany('INSERT OR IGNORE INTO uploads VALUES (?, ?, ?)',
+                                 [(row['sha256'], self._remote_dir(row['remote_path']), row['remote_path'])
+                                  for row in rows])
+
+    @staticmethod
+    def _remote_dir(remote_path):
+        return posixpath.normpath(posixpath.dirname(remote_path))
+
+    def lookup(self, sha256, remote_dir=None):
+        """
+        Возвращает запись о содержимом (и обновляет время обращения) или None.
+        :param remote_dir: Каталог хранилища. Если задан, в поле remote_path записи — путь загрузки
+        в этот каталог (None, если туда содержимое еще не загружалось).
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM content WHERE sha256 = ?', (sha256,)).fetchone()
+            if not row:
+                return None
+            self._db.execute('UPDATE content SET last_access = ? WHERE sha256 = ?', (time.time(), sha256))
+            entry = dict(row)
+            if remote_dir is not None:
+                upload = self._db.execute('SELECT remote_path FROM uploads WHERE sha256 = ? AND remote_dir = ?',
+                                          (sha256, posixpath.normpath(remote_dir))).fetchone()
+                entry['remote_path'] = upload['remote_path'] if upload else None
+        return entry
+
+    def acquire(self, sha256, remote_dir):
+        """
+        Резервирует обработку содержимого текущим потоком. Если такое же вложение уже обрабатывается
+        в другом потоке, дожидается окончания его обработки.
+        :param remote_dir: Каталог хранилища, в который загружается содержимое.
+        :return: Запись индекса, если содержимое уже загружено в этот каталог (обработка не нужна), иначе None.
+        """
+        while True:
+            with self._lock:
+                event = self._in_flight.get(sha256)
+                if event is None:
+                    self._in_flight[sha256] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            entry = self.lookup(sha256, remote_dir)
+        except BaseException:
+            # Иначе резерв остается навсегда и следующие acquire для этого содержимого зависают
+            self.release(sha256)
+            raise
+        if entry and entry['remote_path']:
+            self.release(sha256)
+            return entry
+        return None
+
+    def release(self, sha256):
+        """
+        Снимает резерв, поставленный acquire.
+        """
+        with self._lock:
+            event = self._in_flight.pop(sha256, None)
+        if event is not None:
+            event.set()
+
+    def local_name(self, sha256, name):
+        """
+        Выдает уникальное локальное имя для вложения: исходное имя, если оно не занято другим содержимым,
+        иначе имя с хэшем в конце. Занятость проверяется по имени без расширения, так как после
+        конвертации image001.png и image001.jpg превращаются в один и тот же JPEG.
+        Одно и то же содержимое всегда получает одно и то же имя, поэтому повторный запуск
+        после сбоя продолжает загрузку того же файла.
+        """
+        stem, ext = os.path.splitext(os.path.basename(name))
+        with self._lock:
+            row = self._db.execute('SELECT name FROM content WHERE sha256 = ?', (sha256,)).fetchone()
+            if row:
+                return row['name']
+            if self._stem_taken(stem, sha256):
+                stem = f"{stem}_{sha256[:8]}"
+            self._db.execute('INSERT INTO content (sha256, name, stem, last_access) VALUES (?, ?, ?, ?)',
+                             (sha256, f"{stem}{ext}", stem.lower(), time.time()))
+        return f"{stem}{ext}"
+
+    def frame_name(self, sha256, base_name, index):
+        """
+        Выдает имя JPEG для страницы многостраничного файла (см. FileProcessor.frame_name) и резервирует его:
+        имя base_2.jpg не должно совпасть с вложением base_2.* или страницей другого файла,
+        в том числе пришедшими позже. При совпадении к имени добавляется хэш.
+        :param base_name: Локальное имя файла без расширения (выдано local_name).
+        :param index: Номер страницы с нуля. Первая страница сохраняет имя файла.
+        """
+        if index == 0:
+            return f"{base_name}.jpg"
+        stem = f"{base_name}_{index + 1}"
+        with self._lock:
+            row = self._db.execute('SELECT name FROM frames WHERE sha256 = ? AND page = ?',
+                                   (sha256, index)).fetchone()
+            if row:
+                return row['name']
+            if self._stem_taken(stem, sha256):
+                stem = f"{stem}_{sha256[:8]}"
+            self._db.execute('INSERT INTO frames VALUES (?, ?, ?, ?)', (sha256, index, f"{stem}.jpg", stem.lower()))
+        return f"{stem}.jpg"
+
+    def _stem_taken(self, stem, sha256):
+        """
+        Проверяет, занято ли имя без расширения другим содержимым или страницей другого файла.
+        """
+        stem = stem.lower()
+        return (self._db.execute('SELECT 1 FROM content WHERE stem = ? AND sha256 != ?', (stem, sha256)).fetchone()
+                or self._db.execute('SELECT 1 FROM frames WHERE stem = ? AND sha256 != ?',
+                                    (stem, sha256)).fetchone()) is not None
+
+    def mark_uploaded(self, sha256, local_path, remote_path):
+        """
+        Запоминает, что содержимое обработано и загружено, и вытесняет старые записи при превышении лимитов.
+        """
+        size = os.path.getsize(local_path) if local_path and os.path.exists(local_path) else 0
+        with self._lock:
+            self._db.execute('UPDATE content SET local_path = ?, size = ?, remote_path = ?, last_access = ? '
+                             'WHERE sha256 = ?', (local_path, size, remote_path, time.time(), sha256))
+            self._db.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)',
+                             (sha256, self._remote_dir(remote_path), remote_path))
+        self.evict()
+
+    def evict(self):
+        """
+        Удаляет самые давно использованные локальные файлы, пока их суммарный размер больше max_bytes,
+        и самые старые записи индекса сверх max_entries.
+        """
+        with self._lock:
+            total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM content').fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._db.execute('SELECT sha256, local_path, size FROM content WHERE size > 0 '
+                                        'AND remote_path IS NOT NULL ORDER BY last_access').fetchall()
+                for row in rows:
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(row['local_path'])
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logger.warning(f"Не удалось удалить файл {row['local_path']}: {e}")
+                        continue
+                    self._db.execute('UPDATE content SET local_path = NULL, size = 0 WHERE sha256 = ?',
+                                     (row['sha256'],))
+                    total -= row['size']
+
+            # Записи с файлами на диске не удаляются, чтобы не оставлять файлы без учета
+            removed = self._db.execute('DELETE FROM content WHERE local_path IS NULL AND sha256 IN (SELECT sha256 '
+                                       'FROM content ORDER BY last_access DESC LIMIT -1 OFFSET ?)',
+                                       (self.max_entries,)).rowcount
+            if removed:
+                self._db.execute('DELETE FROM uploads WHERE sha256 NOT IN (SELECT sha256 FROM content)')
+                self._db.execute('DELETE FROM frames WHERE sha256 NOT IN (SELECT sha256 FROM content)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,26 +1,47 @@
 # pip install exchangelib
 
+import json
 import os
+import tempfile
 
-
-from exchangelib import Credentials, Account, DELEGATE, Configuration
-from exchangelib.errors import ErrorNonExistentMailbox
 from loguru import logger
 
+from modules.metrics import metrics
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.gif', '.bmp', '.webp')
+
+# Поля письма, которые нужны для обработки. ItemId и ChangeKey сервер возвращает всегда,
+# вложения приходят только метаданными, содержимое скачивается отдельно.
+MESSAGE_FIELDS = ('subject', 'sender', 'body', 'attachments', 'datetime_received', 'is_read')
+
+# exchangelib (вместе с cryptography, requests_ntlm и lxml) импортируется внутри методов:
+# модуль можно загрузить без него, например для загрузки папок без обращения к Exchange.
+
 
 class EmailHandler:
-    def __init__(self, server: str, username: str, password: str, primary_smtp_address: str) -> None:
+    def __init__(self, server: str, username: str, password: str, primary_smtp_address: str,
+                 state=None, page_size=50, protocol_cache=None) -> None:
         """
         Инициализация обработчика почты.
+        :param state: Локальное состояние синхронизации (MailboxState) для режима sync_mailbox.
+        :param page_size: Число писем, запрашиваемых у сервера за один запрос.
+        :param protocol_cache: Путь к файлу с версией сервера и типом авторизации. Сохраненные значения
+        избавляют каждый запуск от запросов на определение версии EWS и типа авторизации. None — без кэша.
         """
+        from exchangelib import Credentials, Account, DELEGATE, Configuration
+        from exchangelib.errors import ErrorNonExistentMailbox
+
+        self.state = state
+        self.page_size = page_size
         self.server = server
         self.primary_smtp_address = primary_smtp_address
+        self.protocol_cache = protocol_cache
         self.credentials = Credentials(username, password)
 
         self.config = Configuration(
             server=os.environ.get('exchange_server'),
             credentials=self.credentials,
-
+            **self._load_protocol()
         )
 
         try:
@@ -35,6 +56,55 @@ class EmailHandler:
         except ErrorNonExistentMailbox:
             logger.error("Не удалось подключиться к серверу. Проверьте учетные данные.")
             raise ValueError("Не удалось подключиться к серверу. Проверьте учетные данные.")
+        self.subscription_id = None
+
+    def _load_protocol(self):
+        """
+        Читает сохраненные версию сервера и тип авторизации.
+        :return: Аргументы для Configuration (пустой словарь, если кэша нет).
+        """
+        if not self.protocol_cache or not os.path.exists(self.protocol_cache):
+            return {}
+        from exchangelib.version import Build, Version
+
+        try:
+            with open(self.protocol_cache, encoding='utf-8') as file:
+                cached = json.load(file)
+            if cached.get('server') != os.environ.get('exchange_server'):
+                return {}
+            build = Build(*(int(part) for part in cached['build'].split('.')))
+            return {'version': Version(build=build, api_version=cached['api_version']),
+                    'auth_type': cached['auth_type']}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Кэш параметров Exchange не прочитан ({e}), параметры будут определены заново")
+            return {}
+
+    def save_protocol(self):
+        """
+        Сохраняет определенные при работе версию сервера и тип авторизации для следующих запусков.
+        """
+        version, auth_type = self.config.version, self.config.auth_type
+        if not self.protocol_cache or version is None or version.build is None or auth_type is None:
+            return
+        cached = {'server': os.environ.get('exchange_server'), 'build': str(version.build),
+                  'api_version': version.api_version, 'auth_type': auth_type}
+        try:
+            directory = os.path.dirname(self.protocol_cache)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f'{self.protocol_cache}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as file:
+                json.dump(cached, file)
+            os.replace(tmp_path, self.protocol_cache)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить кэш параметров Exchange: {e}")
+
+    def forget_protocol(self):
+        """
+        Удаляет кэш параметров сервера (например, после ошибки: сервер могли обновить).
+        """
+        if self.protocol_cache and os.path.exists(self.protocol_cache):
+            os.remove(self.protocol_cache)
 
     def check_mailbox(self, from_addresses=None):
         """
@@ -49,33 +119,207 @@ class EmailHandler:
             # Фильтруем письма по списку отправителей
             unread_emails = unread_emails.filter(sender__in=from_addresses)
 
+        unread_emails = unread_emails.only(*MESSAGE_FIELDS)
+        unread_emails.page_size = self.page_size
         return unread_emails
 
-    def get_all_mails(self, from_addresses=None):
+    def sync_mailbox(self):
+        """
+        Инкрементальная синхронизация папки "Входящие" через SyncFolderItems: с сервера запрашиваются
+        только изменения с последнего сохраненного checkpoint. Новые письма ставятся в локальную очередь,
+        поэтому не теряются при сбое и не зависят от того, открыл ли письмо человек.
+        При первом запуске в очередь попадают только непрочитанные письма.
+        :return: Список писем (объектов Message), ожидающих обработки.
+        """
+        if self.state is None:
+            raise ValueError("Для синхронизации нужно локальное состояние (MailboxState)")
+
         inbox = self.account.inbox
-        all_emails = inbox.all()
+        sync_state = self.state.get_sync_state('inbox')
+        initial_sync = sync_state is None
+
+        created, deleted = [], []
+        with metrics.timer('ews_sync'):
+            for change_type, item in inbox.sync_items(sync_state=sync_state, only_fields=['is_read']):
+                if change_type == 'create' and not (initial_sync and item.is_read):
+                    created.append((item.id, item.changekey))
+                elif change_type == 'delete':
+                    deleted.append(item.id)
+
+        self.state.add_pending(created)
+        self.state.forget(deleted)
+        self.state.set_sync_state('inbox', inbox.item_sync_state)
+
+        pending = self.state.pending()
+        if not pending:
+            return []
+        logger.info(f"Новых писем: {len(created)}, ожидают обработки: {len(pending)}")
+
+        from exchangelib import Message
+        from exchangelib.errors import ErrorItemNotFound
+
+        emails, missing = [], []
+        with metrics.timer('ews_fetch'):
+            fetched = self.account.fetch(ids=pending, only_fields=MESSAGE_FIELDS, chunk_size=self.page_size)
+            for (item_id, _), item in zip(pending, fetched):
+                if isinstance(item, Message):
+                    emails.append(item)
+                elif isinstance(item, ErrorItemNotFound):
+                    missing.append(item_id)  # письмо удалено или перемещено
+                else:
+                    logger.error(f"Не удалось получить письмо {item_id}: {item}")
+        metrics.count('messages_fetched', len(emails))
+        self.state.forget(missing)
+        return emails
+
+    def mark_processed(self, email):
+        """
+        Отмечает письмо как обработанное в локальном состоянии синхронизации.
+        """
+        if self.state is not None:
+            self.state.mark_processed(email.id)
+
+    def subscribe(self):
+        """
+        Создает streaming-подписку EWS на события папки "Входящие".
+        """
+        self.subscription_id = self.account.inbox.subscribe_to_streaming()
+        logger.info("Создана подписка на новые письма")
+
+    def wait_for_new_mail(self, timeout_minutes=1):
+        """
+        Ждет уведомления о новом письме через streaming-подписку (подписка создается при первом вызове).
+        :param timeout_minutes: Сколько минут держать соединение открытым.
+        :return: True, если пришло новое письмо, False — если за время ожидания писем не было.
+        """
+        from exchangelib.properties import CreatedEvent, NewMailEvent
+
+        if self.subscription_id is None:
+            self.subscribe()
+        try:
+            for notification in self.account.inbox.get_streaming_events(self.subscription_id,
+                                                                        connection_timeout=timeout_minutes):
+                if any(isinstance(event, (NewMailEvent, CreatedEvent)) for event in notification.events):
+                    return True
+        except Exception:
+            # Подписка могла истечь: при следующем вызове она будет создана заново
+            self.subscription_id = None
+            raise
+        return False
+
+    def unsubscribe(self):
+        """
+        Отменяет подписку на новые письма.
+        """
+        if self.subscription_id is None:
+            return
+        try:
+            self.account.inbox.unsubscribe(self.subscription_id)
+        except Exception as e:
+            logger.warning(f"Не удалось отменить подписку: {e}")
+        self.subscription_id = None
+
+    def get_all_mails(self, from_addresses=None, fields=MESSAGE_FIELDS):
+        inbox = self.account.inbox
+        all_emails = inbox.all().only(*fields)
+        all_emails.page_size = self.page_size
 
         return all_emails
 
     @staticmethod
-    def download_attachments(email, download_dir):
+    def is_wanted_attachment(attachment, max_size=None):
+        """
+        Решает по метаданным вложения (тип, имя, размер), нужно ли скачивать его содержимое.
+        :param attachment: Вложение письма.
+        :param max_size: Максимальный размер вложения в байтах. None — без ограничения.
+        :return: True, если вложение похоже на изображение и не превышает лимит.
+        """
+        from exchangelib import FileAttachment
+
+        if not isinstance(attachment, FileAttachment):
+            return False
+
+        name = attachment.name or ''
+        content_type = (attachment.content_type or '').lower()
+        if not content_type.startswith('image/') and not name.lower().endswith(IMAGE_EXTENSIONS):
+            logger.info(f"Вложение {name} пропущено (не является изображением: {content_type})")
+            return False
+
+        if max_size and attachment.size and attachment.size > max_size:
+            logger.warning(f"Вложение {name} пропущено: размер {attachment.size} байт превышает лимит {max_size}")
+            return False
+        return True
+
+    @staticmethod
+    def _stream_attachment(attachment, file_path, chunk_size, max_size=None):
+        """
+        Скачивает содержимое вложения в файл блоками фиксированного размера.
+        :raises ValueError: Если фактический размер превысил max_size.
+        """
+        written = 0
         try:
-            os.makedirs(download_dir, exist_ok=True)
-            saved_files = []
-
-            for attachment in email.attachments:
-                if hasattr(attachment, 'content') and attachment.content:
-                    file_path = os.path.join(download_dir, attachment.name)
-                    with open(file_path, 'wb') as f:
-                        f.write(attachment.content)
-                    saved_files.append(file_path)
-                else:
-                    logger.error(f"Ошибка: Вложение {attachment.name} не содержит контента.")
+            with attachment.fp as fp, open(file_path, 'wb') as f:
+                for chunk in iter(lambda: fp.read(chunk_size), b''):
+                    written += len(chunk)
+                    if max_size and written > max_size:
+                        raise ValueError(f"размер превышает лимит {max_size} байт")
+                    f.write(chunk)
+        except BaseException:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+        return written
 
-            return saved_files
-        except Exception as e:
-            logger.error(f"Ошибка при скачивании вложений: {e}")
-            return []
+    @staticmethod
+    def attachment_key(attachment):
+        """
+        Идентификатор вложения, постоянный между запусками (AttachmentId, при его отсутствии — имя).
+        """
+        return attachment.attachment_id.id if attachment.attachment_id else attachment.name
+
+    @staticmethod
+    def iter_attachments(email, download_dir, max_size=None, memory_limit=16 * 1024 * 1024,
+                         chunk_size=1024 * 1024, skip_ids=()):
+        """
+        Перебирает вложения-изображения письма. Небольшие вложения отдаются содержимым в памяти,
+        крупные скачиваются на диск потоково, поэтому потребление памяти не зависит от размера вложения.
+        :param download_dir: Папка для крупных вложений.
+        :param max_size: Максимальный размер вложения в байтах.
+        :param memory_limit: Вложения не больше этого размера читаются в память.
+        :param chunk_size: Размер блока при скачивании.
+        :param skip_ids: Идентификаторы вложений (attachment_key), которые не нужно скачивать.
+        :return: Генератор кортежей (идентификатор вложения, имя вложения, байты или путь к скачанному файлу).
+        Вместо содержимого None — вложение не удалось скачать.
+        """
+        for attachment in email.attachments:
+            if not EmailHandler.is_wanted_attachment(attachment, max_size):
+                continue
+            attachment_id = EmailHandler.attachment_key(attachment)
+            if attachment_id in skip_ids:
+                continue
+            name = os.path.basename(attachment.name)
+            try:
+                if attachment.size and attachment.size <= memory_limit:
+                    with metrics.timer('attachment_download'):
+                        content = attachment.content
+                    if not content:
+                        logger.error(f"Ошибка: Вложение {name} не содержит контента.")
+                        yield attachment_id, name, None
+                        continue
+                    metrics.add_bytes('attachment_download', len(content))
+                    yield attachment_id, name, content
+                else:
+                    # Уникальное временное имя: одноименные вложения разных писем не перезаписывают друг друга
+                    os.makedirs(download_dir, exist_ok=True)
+                    fd, file_path = tempfile.mkstemp(dir=download_dir, prefix='.', suffix=f'_{name}')
+                    os.close(fd)
+                    with metrics.timer('attachment_download'):
+                        EmailHandler._stream_attachment(attachment, file_path, chunk_size, max_size)
+                    metrics.add_bytes('attachment_download', os.path.getsize(file_path))
+                    yield attachment_id, name, file_path
+            except Exception as e:
+                logger.error(f"Ошибка: Вложение {name} не скачано: {e}")
+                yield attachment_id, name, None
 
     @staticmethod
     def mark_as_read(email):
@@ -83,7 +327,28 @@ class EmailHandler:
         Отмечает письмо как прочитанное.
         """
         email.is_read = True
-        email.save()
+        email.save(update_fields=['is_read'])
         logger.info("Письмо отмечено как прочитанное")
 
+    def mark_as_read_batch(self, emails):
+        """
+        Отмечает несколько писем как прочитанные одним запросом UpdateItem (обновляется только is_read).
+        :param emails: Список писем.
+        :return: Список писем, отмеченных успешно.
+        """
+        emails = list(emails)
+        if not emails:
+            return []
+        for email in emails:
+            email.is_read = True
+        with metrics.timer('ews_mark_read'):
+            # Результаты идут в порядке писем: (id, changekey) или исключение
+            results = list(self.account.bulk_update(items=[(email, ['is_read']) for email in emails],
+                                                    chunk_size=self.page_size))
+        failed = [result for result in results if isinstance(result, Exception)]
+        for error in failed:
+            logger.error(f"Ошибка при отметке письма как прочитанного: {error}")
+        logger.info(f"Отмечено как прочитанные: {len(emails) - len(failed)} из {len(emails)} писем")
+        return [email for email, result in zip(emails, results) if not isinstance(result, Exception)]
+
 
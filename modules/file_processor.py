@@ -1,17 +1,94 @@
 import os
+import re
+import shutil
+import threading
+from concurrent.futures import Future
 
-import exiftool
-from PIL import Image
 from loguru import logger
 
+from modules.image_converter import ImageConverter, to_rgb
+from modules.metrics import metrics
+from modules.utils import shorten
+from modules.xmp_writer import XMPWriteError, inject_jpeg_xmp, write_jpeg_xmp
+
+XMP_LABEL = 'Purple'
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Сигнатуры форматов изображений: (смещение, байты, формат)
+IMAGE_SIGNATURES = [
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'II*\x00', 'tiff'),
+    (0, b'MM\x00*', 'tiff'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (0, b'BM', 'bmp'),
+    (8, b'WEBP', 'webp'),
+]
+
+
+class ExifToolWorker:
+    """
+    Один долгоживущий процесс exiftool (протокол -stay_open), общий для всего запуска программы.
+    """
+
+    def __init__(self):
+        self._et = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _arg(value):
+        """
+        Готовит аргумент для передачи через argfile процесса exiftool.
+        Переводы строк нельзя передать напрямую, поэтому такие аргументы передаются как C-строки (#[CSTR]).
+        """
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        if '\n' in value or '\r' in value:
+            escaped = value.replace('\\', '\\\\').replace('\r', '\\r').replace('\n', '\\n')
+            value = f'#[CSTR]{escaped}'
+        return value.encode('utf-8')
+
+    def execute(self, *params):
+        """
+        Выполняет команду в запущенном процессе exiftool, при необходимости запуская его.
+        :return: Кортеж (stdout, stderr).
+        """
+        with self._lock:
+            if self._et is None or not self._et.running:
+                import exiftool
+
+                self._et = exiftool.ExifTool()
+                self._et.run()
+            with metrics.timer('exiftool'):
+                stdout = self._et.execute(*(self._arg(param) for param in params))
+            return stdout, self._et.last_stderr
+
+    def close(self):
+        with self._lock:
+            if self._et is not None and self._et.running:
+                self._et.terminate()
+            self._et = None
+
 
 class FileProcessor:
     """
     Модуль для обработки файлов. Проверяет тип файлов, конвертирует в JPEG и добавляет метаданные.
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, converter=None):
+        """
+        :param converter: Этап конвертации в JPEG (ImageConverter). По умолчанию — конвертация в текущем процессе.
+        """
+        self.exiftool = ExifToolWorker()
+        self.converter = converter if converter is not None else ImageConverter(workers=0)
+
+    def close(self):
+        """
+        Завершает процесс exiftool и пул конвертации.
+        """
+        self.exiftool.close()
+        self.converter.close()
 
     @staticmethod
     def is_image(file_path):
@@ -20,13 +97,178 @@ class FileProcessor:
         :param file_path: Путь к файлу.
         :return: True, если файл является изображением, иначе False.
         """
+        from PIL import Image
+
         try:
-            with Image.open(file_path) as img:
+            with metrics.timer('is_image'), Image.open(file_path) as img:
                 img.verify()  # Проверяем, является ли файл корректным изображением
             return True
         except (IOError, SyntaxError):
             return False
 
+    @staticmethod
+    def detect_image_type(header):
+        """
+        Определяет формат изображения по первым байтам файла, не декодируя его.
+        :param header: Первые 16 байт файла (или больше).
+        :return: Название формата ('jpeg', 'png', 'tiff', ...) или None, если это не изображение.
+        """
+        for offset, signature, image_type in IMAGE_SIGNATURES:
+            if header[offset:offset + len(signature)] == signature:
+                return image_type
+        return None
+
+    def submit_conversion(self, source, name, frame_name=None):
+        """
+        Определяет тип вложения по сигнатуре и, если нужно, ставит его на конвертацию в JPEG.
+        JPEG не декодируется вовсе, остальные форматы конвертируются в пуле процессов.
+        :param source: Содержимое вложения (bytes) или путь к файлу.
+        :param name: Имя вложения.
+        :param frame_name: frame_name(имя без расширения, номер страницы) — имя JPEG для страницы
+        (например, ContentStore.frame_name, резервирующий имена). По умолчанию — FileProcessor.frame_name.
+        :return: Future со списком кортежей (имя JPEG-файла, байты JPEG или путь к исходному JPEG на диске),
+        по одному на страницу многостраничного файла, или с None, если вложение не изображение.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = bytes(source)
+            header = source[:16]
+        else:
+            # Файл на диске не читается целиком: для определения типа хватает заголовка
+            with open(source, 'rb') as file:
+                header = file.read(16)
+        image_type = self.detect_image_type(header)
+        base_name, ext = os.path.splitext(os.path.basename(name))
+
+        if image_type is None or image_type == 'jpeg':
+            future = Future()
+            if image_type is None:
+                future.set_result(None)
+            else:
+                future.set_result([(name if ext.lower() in JPEG_EXTENSIONS else f"{base_name}.jpg", source)])
+            return future
+
+        if frame_name is None:
+            frame_name = self.frame_name
+        conversion = self.converter.submit(source)
+        future = Future()
+
+        def on_converted(done):
+            if done.exception() is not None:
+                future.set_exception(done.exception())
+            else:
+                frames = done.result()
+                try:
+                    names = [frame_name(base_name, index) for index in range(len(frames))]
+                except Exception as e:
+                    future.set_exception(e)
+                    return
+                logger.info(f"Файл {name} конвертирован в JPEG: {', '.join(names)}")
+                future.set_result(list(zip(names, frames)))
+
+        conversion.add_done_callback(on_converted)
+        return future
+
+    @staticmethod
+    def frame_name(base_name, index):
+        """
+        Имя JPEG для страницы многостраничного файла: первая страница сохраняет имя исходника.
+        """
+        return f"{base_name}.jpg" if index == 0 else f"{base_name}_{index + 1}.jpg"
+
+    def _finish_image(self, conversion, name, output_dir, caption, email_subject, raise_errors=False,
+                      keep_source=False):
+        """
+        Дожидается конвертации, добавляет метаданные и записывает итоговые файлы.
+        :param raise_errors: Пробрасывать ошибку конвертации вместо возврата пустого списка.
+        :param keep_source: Копировать исходный JPEG с диска, а не перемещать его.
+        :return: Список путей к итоговым JPEG (пустой, если вложение не изображение или не обработано).
+        """
+        try:
+            converted = conversion.result()
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"Ошибка при обработке файла {name}: {e}")
+            return []
+        if converted is None:
+            logger.info(f"Загрузка отменена: {name} (не является изображением)")
+            return []
+
+        os.makedirs(output_dir, exist_ok=True)
+        return [self._write_image(jpeg_name, data, output_dir, caption, email_subject, keep_source)
+                for jpeg_name, data in converted]
+
+    def _write_image(self, jpeg_name, data, output_dir, caption, email_subject, keep_source):
+        """
+        Добавляет метаданные и записывает итоговый JPEG.
+        :return: Путь к итоговому JPEG.
+        """
+        jpeg_file_path = os.path.join(output_dir, jpeg_name)
+        needs_exiftool = False
+        try:
+            with metrics.timer('xmp_write'):
+                if isinstance(data, str):
+                    # Крупный JPEG уже скачан на диск: метаданные вставляются потоково, без чтения в память
+                    if os.path.abspath(data) != os.path.abspath(jpeg_file_path):
+                        (shutil.copyfile if keep_source else shutil.move)(data, jpeg_file_path)
+                    write_jpeg_xmp(jpeg_file_path, XMP_LABEL, f'{email_subject}\n{caption}')
+                else:
+                    data = inject_jpeg_xmp(data, XMP_LABEL, f'{email_subject}\n{caption}')
+        except XMPWriteError:
+            # В JPEG уже есть XMP: файл сохраняется как есть, метаданные дописывает exiftool
+            needs_exiftool = True
+
+        if not isinstance(data, str):
+            with open(jpeg_file_path, 'wb') as file:
+                file.write(data)
+
+        if needs_exiftool:
+            self.add_xmp_metadata(jpeg_file_path, caption, email_subject)
+        else:
+            logger.info(f"Добавлены метаданные в файл {jpeg_file_path}: {shorten(caption)}")
+        return jpeg_file_path
+
+    def process_image(self, source, name, output_dir, caption, email_subject, raise_errors=False,
+                      keep_source=False, frame_name=None):
+        """
+        Однопроходная обработка вложения: проверка типа, конвертация в JPEG и запись метаданных.
+        Итоговый файл записывается на диск один раз.
+        :param source: Содержимое вложения (bytes) или путь к уже сохраненному файлу.
+        :param name: Имя вложения.
+        :param output_dir: Папка для итогового файла.
+        :param raise_errors: Пробрасывать ошибки обработки, чтобы отличать их от вложений, не являющихся изображениями.
+        :param keep_source: Не перемещать исходный файл (для файлов из локальных папок, а не временных загрузок).
+        :param frame_name: Имена страниц многостраничного файла (см. submit_conversion).
+        :return: Список путей к итоговым JPEG (по одному на страницу многостраничного файла);
+        пустой, если вложение не изображение или не обработано.
+        """
+        try:
+            conversion = self.submit_conversion(source, name, frame_name)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"Ошибка при обработке файла {name}: {e}")
+            return []
+        return self._finish_image(conversion, name, output_dir, caption, email_subject, raise_errors, keep_source)
+
+    def process_images(self, attachments, output_dir, caption, email_subject):
+        """
+        Обрабатывает вложения письма, сразу ставя все конвертации в пул процессов.
+        Готовые файлы отдаются по порядку, поэтому загрузку файла N можно начинать,
+        пока конвертируется файл N+1.
+        :param attachments: Итерируемые кортежи (имя вложения, содержимое или путь).
+        :return: Генератор путей к итоговым JPEG (необработанные вложения пропускаются).
+        """
+        pending = []
+        for name, source in attachments:
+            try:
+                pending.append((name, self.submit_conversion(source, name)))
+            except Exception as e:
+                logger.error(f"Ошибка при обработке файла {name}: {e}")
+
+        for name, conversion in pending:
+            yield from self._finish_image(conversion, name, output_dir, caption, email_subject)
+
     @staticmethod
     def convert_to_jpeg(file_path):
         """
@@ -41,10 +283,11 @@ class FileProcessor:
             # Файл уже в формате JPEG, ничего не делаем
             return file_path
 
+        from PIL import Image
+
         try:
             with Image.open(file_path) as img:
-                rgb_image = img.convert('RGB')  # Конвертируем в RGB для совместимости
-                rgb_image.save(jpeg_file_path, 'JPEG')
+                to_rgb(img).save(jpeg_file_path, 'JPEG')  # Конвертируем в RGB полосами, без полной копии
                 logger.info(f"Файл {file_path} конвертирован в JPEG: {jpeg_file_path}")
             return jpeg_file_path
         except Exception as e:
@@ -52,27 +295,80 @@ class FileProcessor:
             return None
 
     @staticmethod
-    def add_xmp_metadata(file_path, caption, email_subject):
+    def _xmp_args(caption, email_subject):
+        return [f'-XMP:Label= {XMP_LABEL}',
+                f'-XMP:Description = {email_subject}\n{caption}',
+                # f'-IPTC:Caption-Abstract = {caption}',
+                '-overwrite_original']
+
+    @staticmethod
+    def _write_xmp_fast(file_path, caption, email_subject):
+        """
+        Пытается записать метаданные в JPEG встроенным писателем, без запуска exiftool.
+        :return: True, если метаданные записаны.
+        """
+        if not file_path.lower().endswith(JPEG_EXTENSIONS):
+            return False
+        try:
+            write_jpeg_xmp(file_path, XMP_LABEL, f'{email_subject}\n{caption}')
+            return True
+        except XMPWriteError as e:
+            logger.debug(f"Файл {file_path} будет обработан exiftool: {e}")
+            return False
+
+    def add_xmp_metadata(self, file_path, caption, email_subject):
         """
         Добавляет XMP-метаданные в изображение.
+        JPEG без XMP обрабатывается встроенным писателем, остальные файлы — через exiftool.
         :type caption: object
         :param file_path: Путь к файлу.
         """
         try:
+            if self._write_xmp_fast(file_path, caption, email_subject):
+                logger.info(f"Добавлены метаданные в файл {file_path}: {shorten(caption)}")
+                return
+            self.exiftool.execute(*self._xmp_args(caption, email_subject), file_path)
+            logger.info(f"Добавлены метаданные в файл {file_path}: {shorten(caption)}")
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении метаданных в файл {file_path}: {e}")
 
-            with exiftool.ExifTool() as et:
-                et.execute(
-                    '-XMP:Label= Purple',
-                    f'-XMP:Description = {email_subject}\n{caption}'.encode("utf-8"),
-                    # f'-IPTC:Caption-Abstract = {caption}'.encode("utf-8"),
-                    '-overwrite_original',
-                    file_path.encode('utf-8')
+    def add_xmp_metadata_batch(self, file_paths, caption, email_subject):
+        """
+        Добавляет одинаковые XMP-метаданные в несколько изображений.
+        JPEG обрабатываются встроенным писателем, остальные файлы — одним вызовом exiftool.
+        :param file_paths: Список путей к файлам.
+        :return: Словарь {путь к файлу: True, если метаданные записаны}.
+        """
+        status = {}
+        slow_paths = []
+        for file_path in file_paths:
+            try:
+                if self._write_xmp_fast(file_path, caption, email_subject):
+                    status[file_path] = True
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка при добавлении метаданных в файл {file_path}: {e}")
+                status[file_path] = False
+                continue
+            slow_paths.append(file_path)
 
-                )
+        if slow_paths:
+            try:
+                _, stderr = self.exiftool.execute(*self._xmp_args(caption, email_subject), *slow_paths)
+                # exiftool сообщает об ошибках строками вида "Error: <причина> - <путь к файлу>"
+                failed = set(re.findall(r'^Error: .* - (.+)$', stderr or '', re.M))
+            except Exception as e:
+                logger.error(f"Ошибка при добавлении метаданных в файлы {slow_paths}: {e}")
+                failed = set(slow_paths)
+            status.update({file_path: file_path not in failed for file_path in slow_paths})
 
-            logger.info(f"Добавлены метаданные в файл {file_path}: {caption}")
-        except Exception as e:
-            logger.error(f"Ошибка при добавлении метаданных в файл {file_path}: {e}")
+        if not status:
+            return status
+        for file_path, ok in status.items():
+            if not ok:
+                logger.error(f"Ошибка при добавлении метаданных в файл {file_path}")
+        logger.info(f"Добавлены метаданные в {sum(status.values())} из {len(status)} файлов: {shorten(caption)}")
+        return status
 
 
 # Пример использования
@@ -89,6 +385,7 @@ if __name__ == "__main__":
         # Добавление метаданных
         if jpeg_file:
             _caption = "Lazy dog"
-            processor.add_xmp_metadata(jpeg_file, _caption)
+            processor.add_xmp_metadata(jpeg_file, _caption, "Test subject")
     else:
         print(f"{test_file} — это не изображение.")
+    processor.close()
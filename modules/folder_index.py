@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+
+from modules.utils import open_sqlite
+
+
+class FolderIndex:
+    """
+    Индекс обработанных локальных файлов: путь, время изменения, размер и хэш содержимого.
+    При повторном сканировании папки файлы с теми же mtime и размером пропускаются без чтения,
+    файлы, у которых изменилось только время (копирование, touch), — после сверки хэша.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Путь к файлу базы SQLite.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = open_sqlite(db_path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                remote_path TEXT,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+
+    def snapshot(self, root):
+        """
+        Загружает записи о файлах внутри папки одним запросом, чтобы при сканировании
+        больших архивов не обращаться к базе по каждому файлу.
+        :param root: Папка сканирования.
+        :return: Словарь {путь: (mtime_ns, размер, sha256, путь загрузки)}.
+        """
+        prefix = os.path.join(os.path.abspath(root), '')
+        # Диапазон [prefix, prefix + максимальный символ) использует индекс первичного ключа
+        with self._lock:
+            rows = self._db.execute('SELECT path, mtime_ns, size, sha256, remote_path FROM files '
+                                    'WHERE path >= ? AND path < ?', (prefix, prefix + '\U0010ffff')).fetchall()
+        return {row['path']: (row['mtime_ns'], row['size'], row['sha256'], row['remote_path']) for row in rows}
+
+    def mark_done(self, path, mtime_ns, size, sha256, remote_path=None):
+        """
+        Запоминает, что файл в этом состоянии обработан.
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                             (path, mtime_ns, size, sha256, remote_path, time.time()))
+
+    def touch(self, path, mtime_ns, size):
+        """
+        Обновляет mtime и размер файла, содержимое которого не изменилось.
+        """
+        with self._lock:
+            self._db.execute('UPDATE files SET mtime_ns = ?, size = ?, updated_at = ? WHERE path = ?',
+                             (mtime_ns, size, time.time(), path))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
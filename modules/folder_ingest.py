@@ -0,0 +1,160 @@
+import os
+import posixpath
+import queue
+from functools import partial
+
+from loguru import logger
+
+from files_in_folder_processing import FilesInFolder
+from modules.metrics import metrics
+from modules.stage_runner import STOP, StageRunner
+from modules.utils import file_sha256
+
+
+class FolderIngest(StageRunner):
+    """
+    Загрузка локальных папок (архивов съемок) тем же путем, что и вложения писем:
+    конвертация в JPEG, запись метаданных, загрузка в хранилище. Папка обходится лениво,
+    файлы обрабатываются и загружаются параллельно через ограниченные очереди.
+    Индекс (FolderIndex) хранит mtime, размер и хэш обработанных файлов, поэтому
+    повторный проход по большому архиву обрабатывает только новые и измененные файлы.
+    """
+
+    metrics_prefix = 'folder_'
+
+    def __init__(self, file_processor, uploader, index, remote_dir, output_dir, process_workers=4,
+                 upload_workers=4, queue_size=16, store=None):
+        """
+        :param index: Индекс обработанных файлов (FolderIndex).
+        :param uploader: Хранилище для загрузки файлов (Uploader).
+        :param remote_dir: Каталог в хранилище.
+        :param output_dir: Папка для обработанных файлов. Исходные файлы не изменяются.
+        :param process_workers: Потоки обработки изображений (конвертация идет в пуле процессов FileProcessor).
+        :param upload_workers: Сколько файлов одновременно загружается (передачи идут в пуле хранилища).
+        :param queue_size: Емкость каждой очереди между этапами.
+        :param store: Индекс содержимого (ContentStore): уже загруженные файлы пропускаются. None — без него.
+        """
+        super().__init__()
+        self.file_processor = file_processor
+        self.uploader = uploader
+        self.index = index
+        self.remote_dir = remote_dir
+        self.output_dir = output_dir
+        self.process_workers = process_workers
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
+        self.store = store
+
+    def _same_target(self, previous):
+        """
+        Проверяет, что файл из индекса загружен в текущий каталог хранилища (или не загружался
+        как не-изображение): при загрузке того же архива в другой каталог файлы обрабатываются заново.
+        """
+        remote_path = previous[3]
+        return remote_path is None or posixpath.dirname(remote_path) == posixpath.normpath(self.remote_dir)
+
+    def _scan(self, root, known):
+        """
+        Перебирает новые и измененные файлы папки.
+        :return: Генератор кортежей (путь, mtime_ns, размер).
+        """
+        output_dir = os.path.join(os.path.abspath(self.output_dir), '')
+        for entry in FilesInFolder.iter_files(root):
+            if entry.path.startswith(output_dir):
+                continue  # результаты обработки не обрабатываются повторно
+            stat = entry.stat()
+            self._count('files_scanned')
+            previous = known.get(entry.path)
+            if (previous and previous[0] == stat.st_mtime_ns and previous[1] == stat.st_size
+                    and self._same_target(previous)):
+                self._count('files_unchanged')
+                continue
+            yield entry.path, stat.st_mtime_ns, stat.st_size
+
+    def _process_stage(self, caption, subject):
+        while True:
+            item = self._files.get()
+            if item is STOP:
+                return
+            path, mtime_ns, size, previous = item
+            sha256 = None
+            acquired = False
+            file_paths = []
+            try:
+                with metrics.timer('content_hash'):
+                    sha256 = file_sha256(path)
+                if previous and previous[2] == sha256 and self._same_target(previous):
+                    # Изменилось только время файла: содержимое уже обработано
+                    self.index.touch(path, mtime_ns, size)
+                    self._count('files_unchanged')
+                    continue
+
+                name = os.path.basename(path)
+                if self.store is not None:
+                    entry = self.store.acquire(sha256, self.remote_dir)
+                    if entry is not None:
+                        logger.info(f"Файл {path} уже загружен ранее как {entry['remote_path']}, пропускаем")
+                        self.index.mark_done(path, mtime_ns, size, sha256, entry['remote_path'])
+                        self._count('files_duplicate')
+                        continue
+                    acquired = True
+                    name = self.store.local_name(sha256, name)
+
+                file_subject = subject if subject is not None else os.path.basename(os.path.dirname(path))
+                frame_name = partial(self.store.frame_name, sha256) if acquired else None
+                file_paths = self.file_processor.process_image(path, name, self.output_dir, caption, file_subject,
+                                                               raise_errors=True, keep_source=True,
+                                                               frame_name=frame_name)
+                if not file_paths:
+                    # Расширение изображения, но содержимое не распознано: больше не проверяем, пока файл не изменится
+                    logger.warning(f"Файл {path} не является изображением")
+                    self.index.mark_done(path, mtime_ns, size, sha256)
+                    self._count('files_skipped')
+            except Exception as e:
+                logger.error(f"Ошибка при обработке файла {path}: {e}")
+                self._count('files_failed')
+            finally:
+                if not file_paths and acquired:
+                    self._release(sha256)
+            if file_paths:
+                self._uploads.put((file_paths, self.remote_dir, sha256 if acquired else None,
+                                   (path, mtime_ns, size, sha256)))
+
+    def _uploaded(self, context, file_paths, ok, error):
+        path, mtime_ns, size, sha256 = context
+        if not ok:
+            return  # незагруженный файл не попадает в индекс и будет обработан при следующем проходе
+        remote_path = posixpath.join(self.remote_dir, os.path.basename(file_paths[0]))
+        try:
+            self.index.mark_done(path, mtime_ns, size, sha256, remote_path)
+        except Exception as e:
+            logger.error(f"Ошибка при записи в индекс загруженных файлов: {e}")
+
+    def run(self, root, caption='', subject=None):
+        """
+        Обрабатывает и загружает новые и измененные изображения папки (рекурсивно).
+        :param root: Папка для загрузки.
+        :param caption: Подпись к фото (dc:description).
+        :param subject: Заголовок описания. None — имя папки, в которой лежит файл.
+        :return: Словарь со статистикой прохода.
+        """
+        root = os.path.abspath(root)
+        self.stats = {'files_queued': 0}
+        known = self.index.snapshot(root)
+        logger.info(f"Сканирование папки {root}, в индексе {len(known)} файлов")
+
+        self._files = queue.Queue(self.queue_size)
+        self._uploads = queue.Queue(self.queue_size)
+        processors = self._start(self._process_stage, self.process_workers, 'folder-process', caption, subject)
+        uploaders = self._start(self._upload_stage, 1, 'folder-upload')
+        with metrics.timer('folder_ingest'):
+            try:
+                for path, mtime_ns, size in self._scan(root, known):
+                    self._count('files_queued')
+                    self._files.put((path, mtime_ns, size, known.get(path)))
+            finally:
+                self._stop(processors, self._files)
+                self._stop(uploaders, self._uploads)
+
+        logger.info(f"Загрузка папки {root} завершена: {self.stats}")
+        return self.stats
@@ -1,82 +1,395 @@
-from ftplib import FTP
+import ssl
+import threading
+import time
+from ftplib import FTP, FTP_TLS, all_errors, error_perm, error_temp
 import os
+import posixpath
 from loguru import logger
 
+from modules.connection_pool import ConnectionPool
+from modules.metrics import metrics
+from modules.uploader import Uploader
+from modules.utils import file_sha256
 
-class FTPUploader:
+
+class ReusedSessionFTP_TLS(FTP_TLS):
+    """
+    FTP_TLS с повторным использованием TLS-сессий. Каналы данных открываются с сессией управляющего
+    соединения: серверы с обязательной проверкой этого (vsftpd с require_ssl_reuse, FileZilla Server)
+    иначе отклоняют передачу. Управляющее соединение возобновляет сессию прошлого подключения,
+    поэтому переподключение обходится без полного TLS-рукопожатия.
+    """
+
+    def __init__(self, *args, tls_session=None, **kwargs):
+        """
+        :param tls_session: TLS-сессия прошлого подключения к тому же серверу или None.
+        """
+        super().__init__(*args, **kwargs)
+        self.tls_session = tls_session
+
+    def auth(self):
+        resp = self.voidcmd('AUTH TLS')
+        self.sock = self.context.wrap_socket(self.sock, server_hostname=self.host, session=self.tls_session)
+        self.file = self.sock.makefile(mode='r', encoding=self.encoding)
+        return resp
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+        return conn, size
+
+
+class FTPSession:
+    """
+    Одно долгоживущее подключение к FTP-серверу с кэшем текущего удаленного каталога.
+    """
+
+    def __init__(self, host, username, password, port=21, timeout=30, ssl_context=None):
+        """
+        :param host: Адрес FTP-сервера.
+        :param username: Имя пользователя для авторизации.
+        :param password: Пароль пользователя.
+        :param port: Порт сервера.
+        :param timeout: Таймаут сетевых операций (в секундах).
+        :param ssl_context: Контекст TLS для FTPS (AUTH TLS, защищенные каналы данных). None — обычный FTP.
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.ftp = None
+        self.current_dir = None
+
+    @property
+    def connected(self):
+        return self.ftp is not None and self.ftp.sock is not None
+
+    @property
+    def tls_session(self):
+        """TLS-сессия управляющего соединения (для возобновления при следующем подключении)."""
+        return self.ftp.sock.session if self.ssl_context is not None and self.connected else None
+
+    def open(self, tls_session=None):
+        """
+        Открывает подключение и выполняет авторизацию.
+        :param tls_session: TLS-сессия прошлого подключения для возобновления (только FTPS).
+        """
+        self.close()
+        if self.ssl_context is None:
+            ftp = FTP(timeout=self.timeout)
+        else:
+            ftp = ReusedSessionFTP_TLS(context=self.ssl_context, timeout=self.timeout, tls_session=tls_session)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.username, self.password)  # FTP_TLS включает TLS перед авторизацией
+        if self.ssl_context is not None:
+            ftp.prot_p()
+            if ftp.sock.session_reused:
+                metrics.count('ftps_session_reused')
+        self.ftp = ftp
+        self.current_dir = None
+
+    def is_alive(self, idle, noop_interval):
+        """
+        Проверяет подключение командой NOOP, если оно простаивало дольше noop_interval секунд.
+        :param idle: Сколько секунд подключение простаивало.
+        """
+        if not self.connected:
+            return False
+        if idle < noop_interval:
+            return True
+        try:
+            self.ftp.voidcmd('NOOP')
+            return True
+        except all_errors:
+            return False
+
+    def cwd(self, remote_dir):
+        """
+        Переходит в удаленный каталог, если подключение еще не находится в нем.
+        """
+        if self.current_dir == remote_dir:
+            return
+        self.ftp.cwd(remote_dir)
+        self.current_dir = remote_dir
+
+    def close(self):
+        if self.ftp is None:
+            return
+        try:
+            self.ftp.quit()
+        except all_errors:
+            self.ftp.close()
+        self.ftp = None
+        self.current_dir = None
+
+
+class FTPUploader(Uploader):
     """
-    Класс для загрузки файлов на FTP-сервер и удаления локальных файлов после успешной загрузки.
+    Класс для загрузки файлов на FTP-сервер (или FTPS: tls=True) и удаления локальных файлов после успешной загрузки.
     """
-    def __init__(self, host, username, password, port=21):
+    def __init__(self, host, username, password, port=21, pool_size=2, retries=2, noop_interval=30,
+                 journal=None, chunk_size=1024 * 1024, skip_existing=True, tls=False, ssl_context=None,
+                 create_dirs=True):
         """
         Инициализация подключения к FTP-серверу.
         :param host: Адрес FTP-сервера.
         :param username: Имя пользователя для авторизации.
         :param password: Пароль пользователя.
         :param port: Порт сервера (по умолчанию 21).
+        :param pool_size: Число одновременно открытых FTP-сессий.
+        :param retries: Сколько раз повторять загрузку после обрыва соединения.
+        :param noop_interval: Интервал простоя (в секундах), после которого сессия проверяется NOOP.
+        :param journal: Журнал передачи (TransferJournal) для докачки после сбоя. None — без журнала.
+        :param chunk_size: Размер блока передачи в байтах.
+        :param skip_existing: Пропускать файлы, которые уже лежат на сервере с тем же размером или хэшем.
+        :param tls: Подключаться по FTPS (явный TLS) с шифрованием каналов данных.
+        :param ssl_context: Контекст TLS. None — ssl.create_default_context() с проверкой сертификата.
+        :param create_dirs: Создавать отсутствующие удаленные каталоги.
         """
+        super().__init__(parallel=pool_size, create_dirs=create_dirs)
+        if tls and ssl_context is None:
+            ssl_context = ssl.create_default_context()
         self.host = host
         self.username = username
         self.password = password
         self.port = port
-        self.ftp = FTP()
+        self.retries = retries
+        self.journal = journal
+        self.chunk_size = chunk_size
+        self.skip_existing = skip_existing
+        self.noop_interval = noop_interval
+        self.ssl_context = ssl_context if tls else None
+        self.tls_session = None
+        self._tls_lock = threading.Lock()
+        self.pool = ConnectionPool(self._open_session, lambda session, idle: session.is_alive(idle, noop_interval),
+                                   FTPSession.close, size=pool_size)
+
+    def _open_session(self):
+        """
+        Открывает новую FTP-сессию. FTPS-сессия возобновляет TLS-сессию прошлого подключения.
+        """
+        logger.info(f"Подключение к FTP-серверу {self.host}:{self.port}...")
+        session = FTPSession(self.host, self.username, self.password, self.port, ssl_context=self.ssl_context)
+        with metrics.timer('ftp_connect'):
+            session.open(self.tls_session)
+        if session.tls_session is not None:
+            with self._tls_lock:
+                self.tls_session = session.tls_session
+        logger.info(f"Успешное подключение к {self.host}")
+        return session
+
+    @property
+    def login_count(self):
+        """Число выполненных авторизаций на сервере."""
+        return self.pool.login_count
+
+    @property
+    def reuse_count(self):
+        """Число повторных использований уже открытых сессий."""
+        return self.pool.reuse_count
 
     def connect(self):
         """
-        Подключается к FTP-серверу.
+        Подключается к FTP-серверу. Повторный вызов переиспользует открытую сессию.
         """
         try:
-            logger.info(f"Подключение к FTP-серверу {self.host}:{self.port}...")
-            self.ftp.connect(self.host, self.port)
-            self.ftp.login(self.username, self.password)
-            logger.info(f"Успешное подключение к {self.host}")
+            session = self.pool.acquire()
         except Exception as e:
             logger.error(f"Ошибка подключения к FTP-серверу: {e}")
             raise ConnectionError(f"Ошибка подключения к FTP-серверу: {e}")
+        self.pool.release(session)
 
-    def upload_file(self, file_path, remote_dir="/"):
-        logger.info(f'{remote_dir = }')
-        logger.info(remote_dir == "/PHOTO/INBOX/SHOOTS/BEZ_AVTORA/KSP_018175")
+    @staticmethod
+    def _remote_size(session, file_name):
         """
-        Загружает файл на FTP-сервер.
-        :param file_path: Локальный путь к файлу.
-        :param remote_dir: Удаленный каталог на сервере.
+        Возвращает размер файла на сервере (команда SIZE) или None, если файла нет.
         """
         try:
-            self.ftp.cwd(remote_dir)  # Переход в нужный каталог на сервере
-        except Exception:
-            logger.error(f"Удаленный каталог {remote_dir} не найден.")
-            raise FileNotFoundError(f"Удаленный каталог {remote_dir} не найден.")
+            session.ftp.voidcmd('TYPE I')
+            return session.ftp.size(file_name)
+        except error_perm:
+            return None
 
-        file_name = os.path.basename(file_path)
-        with open(file_path, "rb") as file:
-            logger.info(f"Загрузка файла {file_name} в каталог {remote_dir}...")
-            self.ftp.storbinary(f"STOR {file_name}", file)
-            logger.info(f"Файл {file_name} успешно загружен.")
+    @staticmethod
+    def _remote_sha256(session, file_name):
+        """
+        Запрашивает SHA-256 файла командой HASH, если сервер ее поддерживает. Иначе возвращает None.
+        """
+        try:
+            session.ftp.sendcmd('OPTS HASH SHA-256')
+            response = session.ftp.sendcmd(f'HASH {file_name}')
+        except error_perm:
+            return None
+        # Ответ вида: 213 SHA-256 0-1234 <hash> <file_name>
+        parts = response.split()
+        return parts[3].lower() if len(parts) >= 4 else None
+
+    def _plan_transfer(self, session, file_name, remote_path, size, sha256):
+        """
+        Решает, нужно ли передавать файл и с какого смещения.
+        :return: None, если файл на сервере уже совпадает с локальным, иначе смещение начала передачи.
+        """
+        remote_size = self._remote_size(session, file_name)
+        if remote_size is None:
+            return 0
+
+        entry = self.journal.get(remote_path) if self.journal else None
+        same_content = entry is not None and entry['sha256'] == sha256
+
+        if remote_size == size and self.skip_existing:
+            remote_hash = self._remote_sha256(session, file_name)
+            if remote_hash is not None:
+                return None if remote_hash == sha256 else 0
+            if entry is None or same_content:
+                return None
+
+        if same_content and 0 < remote_size < size:
+            return remote_size
+        return 0
+
+    def _store(self, session, file, file_name, remote_path, offset, result):
+        """
+        Передает файл блоками начиная с offset (REST + STOR, при отказе сервера — APPE).
+        """
+        sent = [offset]
+
+        def on_chunk(chunk):
+            sent[0] += len(chunk)
+            result['bytes'] = sent[0] - offset
+            if self.journal:
+                self.journal.progress(remote_path, sent[0])
+
+        file.seek(offset)
+        if not offset:
+            session.ftp.storbinary(f"STOR {file_name}", file, self.chunk_size, on_chunk)
+            return
+        try:
+            session.ftp.storbinary(f"STOR {file_name}", file, self.chunk_size, on_chunk, rest=offset)
+        except error_perm:
+            file.seek(offset)
+            sent[0] = offset
+            session.ftp.storbinary(f"APPE {file_name}", file, self.chunk_size, on_chunk)
 
-    def upload_files(self, file_paths, remote_dir="/"):
+    def _make_dirs(self, remote_dir, session):
         """
-        Загружает список файлов на FTP-сервер и удаляет их локально после успешной передачи.
-        :param file_paths: Список локальных путей к файлам.
-        :param remote_dir: Удаленный каталог на сервере.
+        Создает каталог и недостающие родительские каталоги на сервере (MKD по частям пути).
         """
-        for file_path in file_paths:
+        logger.info(f"Создание каталога {remote_dir} на FTP-сервере...")
+        for path in self._path_chain(remote_dir):
             try:
-                self.upload_file(file_path, remote_dir)
-                # os.remove(file_path)  # Удаляем файл после успешной загрузки
-                # logger.info(f"Локальный файл {file_path} удален.")
-            except Exception as e:
-                logger.error(f"Ошибка при загрузке файла {file_path}: {e}")
+                session.ftp.mkd(path)
+            except error_perm:
+                pass  # каталог уже есть; если его нельзя создать, ошибку покажет переход в него
+        session.current_dir = None
+
+    def _change_dir(self, session, remote_dir):
+        """
+        Переходит в удаленный каталог, при необходимости создавая его (один раз за время работы).
+        """
+        try:
+            session.cwd(remote_dir)
+            return
+        except error_perm:
+            if not self.create_dirs:
+                logger.error(f"Удаленный каталог {remote_dir} не найден.")
+                raise FileNotFoundError(f"Удаленный каталог {remote_dir} не найден.")
+        self.ensure_dir(remote_dir, session)
+        try:
+            session.cwd(remote_dir)
+            return
+        except error_perm:
+            # Каталог создан ранее, но удален на сервере: создаем заново
+            self.forget_dir(remote_dir)
+            self.ensure_dir(remote_dir, session)
+        try:
+            session.cwd(remote_dir)
+        except error_perm:
+            logger.error(f"Удаленный каталог {remote_dir} не найден и не создан.")
+            raise FileNotFoundError(f"Удаленный каталог {remote_dir} не найден и не создан.")
+
+    def _upload(self, file_path, remote_dir, result):
+        """
+        Выполняет загрузку, по ходу заполняя словарь результата.
+        При обрыве соединения или временной ошибке сервера (4xx, например 421 или 425)
+        переподключается и повторяет загрузку.
+        """
+        file_name = os.path.basename(file_path)
+        remote_path = posixpath.join(remote_dir, file_name)
+        started = time.monotonic()
+        need_hash = self.journal or self.skip_existing
+        size = os.path.getsize(file_path)
+        sha256 = file_sha256(file_path) if need_hash else None
+        try:
+            session = self.pool.acquire()
+        except Exception as e:
+            logger.error(f"Ошибка подключения к FTP-серверу: {e}")
+            raise ConnectionError(f"Ошибка подключения к FTP-серверу: {e}")
+
+        broken = False
+        try:
+            for attempt in range(self.retries + 1):
+                result['retries'] = attempt
+                try:
+                    self._change_dir(session, remote_dir)  # Переход в нужный каталог на сервере
+
+                    with metrics.timer('ftp_probe'):
+                        offset = self._plan_transfer(session, file_name, remote_path, size, sha256)
+                    if offset is None:
+                        logger.info(f"Файл {file_name} уже есть на сервере, загрузка пропущена.")
+                        metrics.count('ftp_skipped')
+                        if self.journal:
+                            self.journal.done(remote_path, file_path, sha256, size)
+                        result['success'] = result['skipped'] = True
+                        return
+
+                    if self.journal:
+                        self.journal.begin(remote_path, file_path, sha256, size, offset)
+                    with open(file_path, "rb") as file:
+                        if offset:
+                            logger.info(f"Докачка файла {file_name} в каталог {remote_dir} с позиции {offset}...")
+                        else:
+                            logger.info(f"Загрузка файла {file_name} в каталог {remote_dir}...")
+                        result['resumed_from'] = offset
+                        with metrics.timer('ftp_store'):
+                            self._store(session, file, file_name, remote_path, offset, result)
+                    metrics.add_bytes('ftp_store', result['bytes'])
+                    if self.journal:
+                        self.journal.done(remote_path, file_path, sha256, size)
+                    logger.info(f"Файл {file_name} успешно загружен.")
+                    result['success'] = True
+                    return
+                except (OSError, EOFError, error_temp) as e:
+                    if isinstance(e, FileNotFoundError):
+                        raise
+                    # Оборванное подключение и сессия после ответа 4xx не возвращаются в пул:
+                    # после 421 сервер закрывает управляющее соединение, после 425 сессия в неясном состоянии
+                    broken = True
+                    if attempt == self.retries:
+                        raise
+                    logger.warning(f"Сбой соединения с FTP-сервером ({e}), повтор {attempt + 1}...")
+                    metrics.count('ftp_retries')
+                    session = self.pool.reconnect(session)
+                    broken = False
+        finally:
+            result['duration'] = time.monotonic() - started
+            self.pool.release(session, broken)
 
     def disconnect(self):
         """
-        Отключается от FTP-сервера.
+        Отключается от FTP-сервера и закрывает журнал передачи.
         """
+        super().disconnect()
         try:
-            self.ftp.quit()
-            logger.info("Отключение от FTP-сервера.")
+            self.pool.close_all()
+            logger.info(f"Отключение от FTP-сервера. Авторизаций: {self.login_count}, "
+                        f"повторных использований сессий: {self.reuse_count}")
         except Exception as e:
             logger.error(f"Ошибка при отключении от FTP-сервера: {e}")
+        if self.journal:
+            self.journal.close()
 
 
 # Пример использования
@@ -100,4 +413,4 @@ if __name__ == "__main__":
         ]
         ftp_uploader.upload_files(test_files, remote_dir="/PHOTO/INBOX/SHOOTS/BEZ_AVTORA/KSP_018175")
     finally:
-        ftp_uploader.disconnect()
\ No newline at end of file
+        ftp_uploader.disconnect()
@@ -0,0 +1,250 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from loguru import logger
+
+from modules.metrics import metrics
+
+# Режимы, для которых ICC-профиль исходника остается верным после конвертации в RGB
+ICC_COMPATIBLE_MODES = ('RGB', 'RGBA', 'RGBX', 'P')
+
+# Теги TIFF, описывающие структуру исходного файла, и встроенные блоки (XMP, IPTC, ICC, Photoshop).
+# В EXIF итогового JPEG они не переносятся.
+TIFF_STRUCTURE_TAGS = (256, 257, 258, 259, 262, 273, 277, 278, 279, 284, 317, 320, 322, 323, 324, 325,
+                       338, 339, 530, 532, 700, 33723, 34377, 34675)
+
+# Размер полосы (в пикселях) при пошаговой конвертации в RGB: временные копии не больше полосы
+STRIP_PIXELS = 4 * 1024 * 1024
+
+# Форматы, страницы которых сохраняются отдельными JPEG. У GIF и WebP кадры — это анимация, берется первый
+MULTIPAGE_FORMATS = ('TIFF',)
+
+# Байт на пиксель в памяти PIL: многоканальные режимы хранятся по 4 байта на пиксель
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2, 'I': 4, 'F': 4}
+
+
+def _open(data):
+    from PIL import Image  # PIL загружается только когда есть что конвертировать
+
+    return Image.open(data if isinstance(data, str) else io.BytesIO(data))
+
+
+def estimate_memory(data, max_size=None):
+    """
+    Оценивает память процесса конвертации по заголовку файла, не декодируя изображение:
+    декодированный исходник, итоговое RGB-изображение и само содержимое файла, если оно передано в память.
+    Для многостраничных файлов оценка ведется по первой странице (страницы обрабатываются по очереди).
+    :return: Оценка в байтах (0, если заголовок не читается — ошибку покажет сама конвертация).
+    """
+    try:
+        with _open(data) as img:
+            width, height = img.size
+            mode = img.mode
+    except Exception:
+        return 0
+    source = width * height * MODE_BYTES.get(mode, 4)
+    scale = min(1.0, max_size / max(width, height)) if max_size else 1.0
+    output = int(width * scale) * int(height * scale) * 4
+    return source + output + (0 if isinstance(data, str) else len(data))
+
+
+def _frames(img, split_frames):
+    """
+    Номера страниц для конвертации. Уменьшенные копии (NewSubfileType с битом 1) пропускаются.
+    """
+    if not split_frames or img.format not in MULTIPAGE_FORMATS or getattr(img, 'n_frames', 1) == 1:
+        return [0]
+    frames = []
+    for index in range(img.n_frames):
+        img.seek(index)
+        if not img.tag_v2.get(254, 0) & 1:
+            frames.append(index)
+    return frames or [0]
+
+
+def _high_bit_depth_scale(img):
+    """
+    Множитель для приведения 16-битных значений к 8 битам. Без него PIL обрезает значения больше 255,
+    и 16-битный снимок становится белым.
+    """
+    if img.mode.startswith('I;16'):
+        return 1 / 256
+    if img.mode == 'I' and img.getextrema()[1] > 255:
+        return 1 / 256
+    return None
+
+
+def to_rgb(img):
+    """
+    Конвертирует изображение в RGB полосами: вместо полной промежуточной копии в каждом режиме
+    (I;16 -> I -> L -> RGB) в памяти одновременно находятся исходник, итоговое изображение и одна полоса.
+    """
+    from PIL import Image
+
+    if img.mode == 'RGB':
+        return img
+    width, height = img.size
+    rows = max(1, STRIP_PIXELS // max(width, 1))
+    scale = _high_bit_depth_scale(img)
+    rgb_image = Image.new('RGB', img.size)
+    for top in range(0, height, rows):
+        box = (0, top, width, min(top + rows, height))
+        strip = img.crop(box)
+        if scale:
+            strip = strip.convert('I').point(lambda value: value * scale).convert('L')
+        rgb_image.paste(strip.convert('RGB'), box)
+        del strip
+    return rgb_image
+
+
+def encode_jpeg_frames(data, quality=90, subsampling='4:2:0', progressive=False, optimize=True, max_size=None,
+                       split_frames=True):
+    """
+    Декодирует изображение и кодирует его в JPEG. Выполняется в процессе пула конвертации.
+    Страницы многостраничного файла обрабатываются по очереди, поэтому в памяти всегда одна страница.
+    :param data: Содержимое исходного файла (bytes) или путь к нему.
+    :param quality: Качество JPEG (1-95).
+    :param subsampling: Субдискретизация цвета ('4:4:4', '4:2:2', '4:2:0').
+    :param progressive: Записывать прогрессивный JPEG.
+    :param optimize: Оптимизировать таблицы Хаффмана.
+    :param max_size: Максимальный размер большей стороны в пикселях. None — без уменьшения.
+    :param split_frames: Сохранять страницы многостраничного TIFF отдельными JPEG. False — только первую.
+    :return: Список байтов JPEG, по одному на страницу.
+    """
+    save_args = {'quality': quality, 'subsampling': subsampling,
+                 'progressive': progressive, 'optimize': optimize}
+    results = []
+    with _open(data) as img:
+        for index in _frames(img, split_frames):
+            img.seek(index)
+            frame_args = dict(save_args)
+            icc_profile = img.info.get('icc_profile') if img.mode in ICC_COMPATIBLE_MODES else None
+            if icc_profile:
+                frame_args['icc_profile'] = icc_profile
+            exif = img.getexif()
+            for tag in TIFF_STRUCTURE_TAGS:
+                exif.pop(tag, None)
+            if len(exif):
+                frame_args['exif'] = exif.tobytes()
+
+            if max_size and max(img.size) > max_size:
+                # thumbnail использует draft/reduce, поэтому большие исходники не декодируются в полном разрешении
+                img.thumbnail((max_size, max_size), reducing_gap=2.0)
+
+            rgb_image = to_rgb(img)  # Конвертируем в RGB для совместимости
+            buffer = io.BytesIO()
+            rgb_image.save(buffer, 'JPEG', **frame_args)
+            del rgb_image
+            results.append(buffer.getvalue())
+    return results
+
+
+class ImageConverter:
+    """
+    Этап конвертации изображений в JPEG на пуле процессов: тяжелое декодирование TIFF/PNG
+    распределяется по ядрам и идет параллельно с загрузкой уже готовых файлов.
+    Бюджет памяти ограничивает суммарную оценку памяти одновременно конвертируемых изображений:
+    крупный скан ждет, пока освободится место, вместо того чтобы вместе с другими исчерпать память.
+    """
+
+    def __init__(self, workers=None, quality=90, subsampling='4:2:0', progressive=False, optimize=True,
+                 max_size=None, split_frames=True, memory_budget=None):
+        """
+        :param workers: Число процессов. None — по числу ядер, 0 — конвертация в текущем процессе.
+        :param split_frames: Сохранять страницы многостраничного TIFF отдельными JPEG.
+        :param memory_budget: Бюджет памяти процессов конвертации в байтах (по оценке estimate_memory).
+        Изображение больше бюджета конвертируется, только когда пул свободен. None — без ограничения.
+        Остальные параметры — настройки кодировщика JPEG (см. encode_jpeg_frames).
+        """
+        self.workers = os.cpu_count() if workers is None else workers
+        self.settings = {'quality': quality, 'subsampling': subsampling, 'progressive': progressive,
+                         'optimize': optimize, 'max_size': max_size, 'split_frames': split_frames}
+        self.memory_budget = memory_budget
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._memory = threading.Condition()
+        self._reserved = 0
+        self._running = 0
+
+    def _reserve(self, cost):
+        """
+        Дожидается, пока оценка памяти изображения поместится в бюджет, и резервирует ее.
+        """
+        with self._memory:
+            if self._running and self._reserved + cost > self.memory_budget:
+                logger.info(f"Конвертация ждет освобождения памяти: нужно {cost / 1024 ** 2:.0f} МБ, "
+                            f"занято {self._reserved / 1024 ** 2:.0f} из {self.memory_budget / 1024 ** 2:.0f} МБ")
+                with metrics.timer('convert_memory_wait'):
+                    self._memory.wait_for(lambda: not self._running
+                                          or self._reserved + cost <= self.memory_budget)
+            self._reserved += cost
+            self._running += 1
+
+    def _release(self, cost):
+        with self._memory:
+            self._reserved -= cost
+            self._running -= 1
+            self._memory.notify_all()
+
+    def submit(self, data):
+        """
+        Ставит изображение в очередь на конвертацию. При заданном бюджете памяти может блокироваться,
+        пока не завершатся уже запущенные конвертации.
+        :param data: Содержимое исходного файла (bytes) или путь к нему. Путь дешевле передавать в пул,
+        чем копировать содержимое между процессами.
+        :return: Future со списком байтов JPEG (по одному на страницу).
+        """
+        if not self.workers:
+            future = Future()
+            try:
+                future.set_result(self.convert(data))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        cost = 0
+        if self.memory_budget:
+            cost = estimate_memory(data, self.settings['max_size'])
+            self._reserve(cost)
+        try:
+            with self._executor_lock:
+                if self._executor is None:
+                    # Пул создается только когда появляется работа
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                    logger.info(f"Запущен пул конвертации изображений: {self.workers} процессов")
+                executor = self._executor
+            # Время учитывается от постановки в очередь: в него входит и ожидание свободного процесса
+            submitted = time.perf_counter()
+            future = executor.submit(encode_jpeg_frames, data, **self.settings)
+        except Exception:
+            if self.memory_budget:
+                self._release(cost)
+            raise
+        future.add_done_callback(lambda done: self._record(done, time.perf_counter() - submitted, cost))
+        return future
+
+    def _record(self, future, seconds, cost):
+        if self.memory_budget:
+            self._release(cost)
+        metrics.observe('convert', seconds)
+        if not future.cancelled() and future.exception() is None:
+            metrics.add_bytes('convert', sum(len(jpeg) for jpeg in future.result()))
+
+    def convert(self, data):
+        """
+        Конвертирует изображение в текущем процессе.
+        :return: Список байтов JPEG (по одному на страницу).
+        """
+        with metrics.timer('convert'):
+            frames = encode_jpeg_frames(data, **self.settings)
+        metrics.add_bytes('convert', sum(len(jpeg) for jpeg in frames))
+        return frames
+
+    def close(self):
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
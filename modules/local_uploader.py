@@ -0,0 +1,66 @@
+import os
+import shutil
+import time
+
+from loguru import logger
+
+from modules.metrics import metrics
+from modules.uploader import Uploader
+
+
+class LocalUploader(Uploader):
+    """
+    «Загрузка» в локальную или смонтированную сетевую папку. Удаленный каталог отсчитывается от root.
+    Файл копируется во временное имя и переименовывается, поэтому в папке не бывает недописанных файлов.
+    """
+
+    def __init__(self, root, parallel=4, create_dirs=True):
+        """
+        :param root: Корневая папка хранилища.
+        :param parallel: Число одновременных копирований.
+        :param create_dirs: Создавать отсутствующие каталоги.
+        """
+        super().__init__(parallel=parallel, create_dirs=create_dirs)
+        self.root = os.path.abspath(root)
+
+    def _target_dir(self, remote_dir):
+        target_dir = os.path.normpath(os.path.join(self.root, remote_dir.lstrip('/')))
+        if os.path.commonpath([self.root, target_dir]) != self.root:
+            raise ValueError(f"Каталог {remote_dir} выходит за пределы {self.root}")
+        return target_dir
+
+    def _make_dirs(self, remote_dir):
+        target_dir = self._target_dir(remote_dir)
+        if os.path.isdir(target_dir):
+            return
+        if not self.create_dirs:
+            logger.error(f"Каталог {target_dir} не найден.")
+            raise FileNotFoundError(f"Каталог {target_dir} не найден.")
+        logger.info(f"Создание каталога {target_dir}...")
+        os.makedirs(target_dir, exist_ok=True)
+
+    def _upload(self, file_path, remote_dir, result):
+        file_name = os.path.basename(file_path)
+        started = time.monotonic()
+        try:
+            self.ensure_dir(remote_dir)
+            target_dir = self._target_dir(remote_dir)
+            tmp_path = os.path.join(target_dir, f'.{file_name}.part')
+            logger.info(f"Копирование файла {file_name} в {target_dir}...")
+            with metrics.timer('local_store'):
+                try:
+                    shutil.copyfile(file_path, tmp_path)
+                except FileNotFoundError:
+                    if os.path.isdir(target_dir):
+                        raise
+                    # Каталог удалили после проверки: создаем заново
+                    self.forget_dir(remote_dir)
+                    self.ensure_dir(remote_dir)
+                    shutil.copyfile(file_path, tmp_path)
+                os.replace(tmp_path, os.path.join(target_dir, file_name))
+            result['bytes'] = os.path.getsize(file_path)
+            metrics.add_bytes('local_store', result['bytes'])
+            logger.info(f"Файл {file_name} успешно скопирован.")
+            result['success'] = True
+        finally:
+            result['duration'] = time.monotonic() - started
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from modules.utils import open_sqlite
+
+
+class MailboxState:
+    """
+    Локальное состояние синхронизации почтового ящика: checkpoint SyncFolderItems
+    и список писем (по ItemId), ожидающих обработки или уже обработанных.
+    """
+
+    PENDING = 'pending'
+    PROCESSED = 'processed'
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Путь к файлу базы SQLite.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = open_sqlite(db_path)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                folder TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS items (
+                item_id TEXT PRIMARY KEY,
+                changekey TEXT,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS items_status ON items (status);
+            """
+        )
+
+    def get_sync_state(self, folder):
+        """
+        Возвращает сохраненный checkpoint синхронизации папки или None при первом запуске.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT state FROM sync_state WHERE folder = ?', (folder,)).fetchone()
+        return row['state'] if row else None
+
+    def set_sync_state(self, folder, state):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)', (folder, state, time.time()))
+
+    def add_pending(self, items):
+        """
+        Добавляет новые письма в очередь на обработку. Уже известные письма не меняются.
+        :param items: Кортежи (item_id, changekey).
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR IGNORE INTO items VALUES (?, ?, ?, ?)',
+                                 [(item_id, changekey, self.PENDING, now) for item_id, changekey in items])
+
+    def pending(self):
+        """
+        Возвращает письма, ожидающие обработки, списком кортежей (item_id, changekey).
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT item_id, changekey FROM items WHERE status = ? ORDER BY updated_at',
+                                    (self.PENDING,)).fetchall()
+        return [(row['item_id'], row['changekey']) for row in rows]
+
+    def mark_processed(self, item_id):
+        with self._lock:
+            self._db.execute('UPDATE items SET status = ?, updated_at = ? WHERE item_id = ?',
+                             (self.PROCESSED, time.time(), item_id))
+
+    def forget(self, item_ids):
+        """
+        Удаляет письма из очереди (например, если они удалены из ящика).
+        """
+        with self._lock:
+            self._db.executemany('DELETE FROM items WHERE item_id = ?', [(item_id,) for item_id in item_ids])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
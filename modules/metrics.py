@@ -0,0 +1,216 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+# Границы корзин гистограммы длительностей (в секундах)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+PROFILE_ENV = 'EFP_PROFILE'
+
+
+class Metrics:
+    """
+    Простой потокобезопасный реестр метрик: гистограммы длительностей этапов, счетчики байт и событий.
+    Выгружается в текстовом формате Prometheus и в JSON-сводку запуска.
+    """
+
+    def __init__(self, prefix='efp'):
+        self.prefix = prefix
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._bytes = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        """
+        Добавляет длительность этапа в гистограмму.
+        """
+        with self._lock:
+            histogram = self._durations.get(stage)
+            if histogram is None:
+                histogram = self._durations[stage] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0,
+                                                      'count': 0, 'max': 0.0}
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Измеряет длительность блока кода: with metrics.timer('ftp_store'): ...
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def add_bytes(self, stage, value):
+        with self._lock:
+            self._bytes[stage] = self._bytes.get(stage, 0) + value
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self._durations.clear()
+            self._bytes.clear()
+            self._counters.clear()
+
+    def to_prometheus(self):
+        """
+        Возвращает метрики в текстовом формате Prometheus.
+        """
+        prefix = self.prefix
+        with self._lock:
+            lines = [f'# HELP {prefix}_stage_seconds Длительность этапов обработки',
+                     f'# TYPE {prefix}_stage_seconds histogram']
+            for stage, histogram in sorted(self._durations.items()):
+                cumulative = 0
+                for bound, value in zip(BUCKETS, histogram['buckets']):
+                    cumulative += value
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+            lines += [f'# HELP {prefix}_bytes_total Объем данных, прошедших через этап',
+                      f'# TYPE {prefix}_bytes_total counter']
+            lines += [f'{prefix}_bytes_total{{stage="{stage}"}} {value}' for stage, value in sorted(self._bytes.items())]
+
+            lines += [f'# HELP {prefix}_events_total Счетчики событий',
+                      f'# TYPE {prefix}_events_total counter']
+            lines += [f'{prefix}_events_total{{event="{name}"}} {value}'
+                      for name, value in sorted(self._counters.items())]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Возвращает сводку запуска: длительность, по каждому этапу число вызовов, суммарное, среднее
+        и максимальное время, объемы данных и счетчики событий.
+        """
+        with self._lock:
+            stages = {stage: {'count': histogram['count'],
+                              'total': round(histogram['sum'], 6),
+                              'mean': round(histogram['sum'] / histogram['count'], 6),
+                              'max': round(histogram['max'], 6)}
+                      for stage, histogram in self._durations.items() if histogram['count']}
+            return {'started_at': self.started_at,
+                    'duration': round(time.time() - self.started_at, 3),
+                    'stages': stages,
+                    'bytes': dict(self._bytes),
+                    'counters': dict(self._counters)}
+
+    @staticmethod
+    def _write_atomic(path, text):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmp_path, path)
+
+    def write_prometheus(self, path):
+        """
+        Записывает метрики в файл (например, для textfile collector node_exporter).
+        """
+        self._write_atomic(path, self.to_prometheus())
+
+    def write_summary(self, path, **extra):
+        """
+        Записывает JSON-сводку запуска.
+        :param extra: Дополнительные поля сводки (например, статистика последнего прохода).
+        """
+        summary = self.summary()
+        summary.update(extra)
+        self._write_atomic(path, json.dumps(summary, ensure_ascii=False, indent=2))
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Запускает HTTP-эндпоинт /metrics в фоновом потоке.
+        :return: Сервер (для остановки вызвать shutdown()).
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+        return server
+
+
+# Общий реестр метрик программы
+metrics = Metrics()
+
+
+@contextmanager
+def profiling(env_var=PROFILE_ENV):
+    """
+    Включает cProfile, если задана переменная окружения EFP_PROFILE с путем к файлу статистики.
+    Профилируются текущий поток и все потоки, запущенные внутри блока (этапы конвейера, пулы загрузки),
+    статистика потоков объединяется в один файл. Процессы пула конвертации не профилируются:
+    их время видно в метрике convert. Статистику потом можно открыть через pstats или snakeviz.
+    """
+    path = os.environ.get(env_var)
+    if not path:
+        yield
+        return
+
+    profilers = [cProfile.Profile()]
+    lock = threading.Lock()
+
+    def profile_thread(frame, event, arg):
+        # Вызывается в новом потоке до первой его функции и заменяется профилировщиком этого потока
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Python 3.12+: профилировщик уже включен и видит все потоки
+            sys.setprofile(None)
+            return
+        with lock:
+            profilers.append(profiler)
+
+    threading.setprofile(profile_thread)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        with lock:
+            stats = pstats.Stats(*profilers)
+        stats.dump_stats(path)
+        logger.info(f"Профиль сохранен в {path}, потоков: {len(profilers)}, всего вызовов: {stats.total_calls}")
@@ -0,0 +1,381 @@
+import hashlib
+import os
+import queue
+import threading
+from functools import partial
+
+from loguru import logger
+
+from modules.metrics import metrics
+from modules.stage_runner import STOP, StageRunner
+from modules.utils import file_sha256
+from modules.work_ledger import WorkLedger
+
+
+class MessageJob:
+    """
+    Письмо в конвейере. Считает незавершенные вложения, чтобы подтвердить письмо
+    только после загрузки всех его файлов.
+    """
+
+    def __init__(self, email):
+        self.email = email
+        self.caption = ''
+        self.subject = email.subject
+        self.remote_dir = None
+        self.pending = 0
+        self.failed = False
+        self.sealed = False
+        self.files = []
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.pending += 1
+
+    def finish(self, ok=True, file_paths=()):
+        """
+        Отмечает завершение работы с одним вложением.
+        :param file_paths: Итоговые файлы вложения (несколько — у многостраничного файла).
+        :return: True, если письмо полностью обработано.
+        """
+        with self._lock:
+            self.pending -= 1
+            self.failed = self.failed or not ok
+            self.files.extend(file_paths)
+            return self.sealed and self.pending == 0
+
+    def seal(self, ok=True):
+        """
+        Отмечает, что все вложения письма поставлены в очередь.
+        :return: True, если письмо полностью обработано.
+        """
+        with self._lock:
+            self.sealed = True
+            self.failed = self.failed or not ok
+            return self.pending == 0
+
+
+class MailPipeline(StageRunner):
+    """
+    Конвейер обработки писем: получение писем -> скачивание вложений -> обработка изображений ->
+    загрузка в хранилище -> подтверждение. Этапы связаны ограниченными очередями (обратное давление),
+    у каждого этапа свое число потоков, поэтому скорость определяется самым медленным этапом,
+    а не суммой всех. Письмо отмечается прочитанным только после загрузки всех его файлов.
+    С журналом (WorkLedger) этапы каждого вложения сохраняются, и после сбоя письмо продолжается
+    с последнего завершенного этапа, а письмо с ошибкой повторяется с нарастающей паузой.
+    """
+
+    def __init__(self, email_handler, file_processor, text_processor, uploader, router, download_dir,
+                 download_workers=2, process_workers=4, upload_workers=4, queue_size=16, ack_batch_size=50,
+                 max_attachment_size=None, memory_limit=16 * 1024 * 1024, chunk_size=1024 * 1024, store=None,
+                 ledger=None):
+        """
+        :param uploader: Хранилище для загрузки файлов (Uploader: FTP, FTPS, SFTP, локальная папка).
+        :param router: Выбор каталога загрузки по отправителю и теме письма (UploadRouter).
+        :param download_dir: Папка для скачанных и обработанных файлов.
+        :param download_workers: Потоки скачивания вложений.
+        :param process_workers: Потоки обработки изображений (конвертация идет в пуле процессов FileProcessor).
+        :param upload_workers: Сколько вложений одновременно загружается (передачи идут в пуле хранилища).
+        :param queue_size: Емкость каждой очереди между этапами.
+        :param ack_batch_size: Сколько писем отмечать прочитанными одним запросом.
+        :param store: Индекс содержимого (ContentStore): уже загруженные вложения пропускаются. None — без него.
+        :param ledger: Журнал обработки (WorkLedger) для возобновления после сбоя. None — без него.
+        """
+        super().__init__()
+        self.email_handler = email_handler
+        self.file_processor = file_processor
+        self.text_processor = text_processor
+        self.uploader = uploader
+        self.router = router
+        self.download_dir = download_dir
+        self.download_workers = download_workers
+        self.process_workers = process_workers
+        self.upload_workers = upload_workers
+        self.queue_size = queue_size
+        self.ack_batch_size = ack_batch_size
+        self.max_attachment_size = max_attachment_size
+        self.memory_limit = memory_limit
+        self.chunk_size = chunk_size
+        self.store = store
+        self.ledger = ledger
+
+    def _complete(self, job):
+        """
+        Передает полностью обработанное письмо на подтверждение.
+        """
+        if job.failed:
+            self._count('messages_failed')
+            logger.error(f"Письмо «{job.subject}» обработано с ошибками и не будет отмечено прочитанным")
+            delay = self._record('message_failed', job, "Не все вложения загружены")
+            if delay is not None:
+                logger.info(f"Повтор письма «{job.subject}» не раньше чем через {delay:.0f} с")
+        else:
+            self._record('message_uploaded', job)
+            self._acks.put(job)
+
+    @staticmethod
+    def _file_stats(file_paths):
+        """
+        :return: Список (путь, размер, mtime_ns) для записи в журнал.
+        """
+        stats = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            stats.append((file_path, stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    @staticmethod
+    def _files_intact(files):
+        """
+        Проверяет, что обработанные файлы вложения остались на диске без изменений.
+        """
+        if not files:
+            return False
+        for file_path, size, mtime_ns in files:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return False
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                return False
+        return True
+
+    def _resume(self, job):
+        """
+        Восстанавливает этапы вложений письма из журнала: загруженные и пропущенные вложения не скачиваются,
+        обработанные (файлы на месте и не изменились) сразу ставятся на загрузку.
+        :return: Идентификаторы вложений, которые не нужно скачивать.
+        """
+        skip_ids = set()
+        for attachment_id, entry in self.ledger.attachments(job.email.id).items():
+            stage, name, sha256 = entry['stage'], entry['name'], entry['sha256']
+            if stage in (WorkLedger.UPLOADED, WorkLedger.SKIPPED):
+                skip_ids.add(attachment_id)
+                if stage == WorkLedger.UPLOADED:
+                    self._count('files_already_uploaded')
+            elif stage in (WorkLedger.PROCESSED, WorkLedger.FAILED) and self._files_intact(entry['files']):
+                skip_ids.add(attachment_id)
+                if self.store is not None and sha256 and self.store.acquire(sha256, job.remote_dir) is not None:
+                    # Пока письмо ждало повтора, то же содержимое загружено из другого письма
+                    self._record('attachment_uploaded', job, attachment_id, name, sha256)
+                    self._count('files_duplicate')
+                    continue
+                logger.info(f"Вложение {name} уже обработано, продолжаем с загрузки")
+                self._count('files_resumed')
+                job.add()
+                self._uploads.put(([file_path for file_path, _, _ in entry['files']], job.remote_dir, sha256,
+                                   (job, attachment_id, name)))
+        return skip_ids
+
+    def _is_due(self, email):
+        """
+        Проверяет по журналу, не ждет ли письмо паузы после ошибки, и заводит запись о нем.
+        Если журнал недоступен, письмо обрабатывается: повторная загрузка отсекается индексом содержимого.
+        """
+        if self.ledger is None:
+            return True
+        try:
+            if not self.ledger.is_due(email.id):
+                return False
+            self.ledger.begin_message(email.id, email.subject)
+        except Exception as e:
+            logger.error(f"Ошибка чтения журнала обработки: {e}")
+        return True
+
+    def _record(self, method, job, *args):
+        """
+        Записывает этап письма или вложения в журнал (если он задан). Ошибка записи не прерывает обработку:
+        в худшем случае после сбоя этап будет выполнен повторно.
+        :param method: Метод WorkLedger, первым аргументом получает ItemId письма.
+        :return: Результат метода или None, если журнала нет или запись не удалась.
+        """
+        if self.ledger is None:
+            return None
+        try:
+            return getattr(self.ledger, method)(job.email.id, *args)
+        except Exception as e:
+            logger.error(f"Ошибка записи в журнал обработки: {e}")
+            return None
+
+    def _download_stage(self):
+        while True:
+            job = self._messages.get()
+            if job is STOP:
+                return
+            ok = True
+            try:
+                logger.info(f"Получено письмо от: {job.email.sender.email_address}")
+                logger.info(f"Тема: {job.subject}")
+                job.remote_dir = self.router.route(job.email.sender.email_address, job.subject)
+                with metrics.timer('caption'):
+                    job.caption = self.text_processor.extract_clean_text(
+                        self.text_processor.html_to_text(job.email.body))
+
+                skip_ids = self._resume(job) if self.ledger is not None else ()
+                attachments = self.email_handler.iter_attachments(job.email, self.download_dir,
+                                                                  max_size=self.max_attachment_size,
+                                                                  memory_limit=self.memory_limit,
+                                                                  chunk_size=self.chunk_size,
+                                                                  skip_ids=skip_ids)
+                for attachment_id, name, source in attachments:
+                    job.add()
+                    self._attachments.put((job, attachment_id, name, source))
+            except Exception as e:
+                logger.error(f"Ошибка при скачивании вложений письма «{job.subject}»: {e}")
+                ok = False
+            if job.seal(ok):
+                self._complete(job)
+
+    def _check_duplicate(self, source, name, remote_dir):
+        """
+        Ищет вложение в индексе содержимого среди загруженных в каталог remote_dir.
+        :return: Кортеж (sha256, уникальное имя, признак «уже загружено»). Если вложение не загружено,
+        содержимое зарезервировано (ContentStore.acquire) и резерв нужно снять через release.
+        """
+        with metrics.timer('content_hash'):
+            if isinstance(source, str):
+                sha256 = file_sha256(source)
+            else:
+                sha256 = hashlib.sha256(source).hexdigest()
+        entry = self.store.acquire(sha256, remote_dir)
+        if entry is not None:
+            logger.info(f"Вложение {name} уже загружено ранее как {entry['remote_path']}, пропускаем")
+            return sha256, name, True
+        try:
+            return sha256, self.store.local_name(sha256, name), False
+        except BaseException:
+            self._release(sha256)
+            raise
+
+    @staticmethod
+    def _remove_download(source, file_paths):
+        """
+        Удаляет временный файл потокового скачивания, если он не стал итоговым файлом.
+        """
+        if isinstance(source, str) and source not in file_paths:
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Не удалось удалить временный файл {source}: {e}")
+
+    def _process_stage(self):
+        while True:
+            item = self._attachments.get()
+            if item is STOP:
+                return
+            job, attachment_id, name, source = item
+            ok = True
+            sha256 = None
+            acquired = False
+            file_paths = []
+            try:
+                if source is None:
+                    raise ValueError("вложение не скачано")
+                duplicate = False
+                if self.store is not None:
+                    sha256, name, duplicate = self._check_duplicate(source, name, job.remote_dir)
+                    acquired = not duplicate
+                if duplicate:
+                    self._count('files_duplicate')
+                    self._record('attachment_uploaded', job, attachment_id, name, sha256)
+                else:
+                    # Пустой список — вложение не является изображением: это не ошибка, оно просто не загружается
+                    frame_name = partial(self.store.frame_name, sha256) if self.store is not None else None
+                    file_paths = self.file_processor.process_image(source, name, self.download_dir,
+                                                                   job.caption, job.subject, raise_errors=True,
+                                                                   frame_name=frame_name)
+                    if file_paths:
+                        self._record('attachment_processed', job, attachment_id, name, sha256,
+                                     self._file_stats(file_paths))
+                    else:
+                        self._record('attachment_skipped', job, attachment_id, name)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке файла {name}: {e}")
+                self._record('attachment_failed', job, attachment_id, name, e)
+                ok = False
+            self._remove_download(source, file_paths)
+
+            if not file_paths:
+                if acquired:
+                    self._release(sha256)
+                if job.finish(ok):
+                    self._complete(job)
+                continue
+            self._uploads.put((file_paths, job.remote_dir, sha256, (job, attachment_id, name)))
+
+    def _uploaded(self, context, file_paths, ok, error):
+        job, attachment_id, name = context
+        if ok:
+            self._record('attachment_uploaded', job, attachment_id, name)
+        else:
+            self._record('attachment_failed', job, attachment_id, name, error)
+        if job.finish(ok, file_paths):
+            self._complete(job)
+
+    def _ack_stage(self):
+        batch = []
+        stopping = False
+        while not stopping or batch:
+            try:
+                job = self._acks.get(timeout=0.5) if not stopping else STOP
+            except queue.Empty:
+                job = None
+            if job is STOP:
+                stopping = True
+            elif job is not None:
+                try:
+                    self.email_handler.mark_processed(job.email)
+                except Exception as e:
+                    logger.error(f"Ошибка при сохранении состояния письма «{job.subject}»: {e}")
+                batch.append(job.email)
+
+            if batch and (stopping or job is None or len(batch) >= self.ack_batch_size):
+                try:
+                    marked = self.email_handler.mark_as_read_batch(batch)
+                    self._count('messages_acked', len(marked))
+                except Exception as e:
+                    logger.error(f"Ошибка при отметке писем как прочитанных: {e}")
+                    marked = []
+                if marked and self.ledger is not None:
+                    try:
+                        self.ledger.message_done([email.id for email in marked])
+                    except Exception as e:
+                        logger.error(f"Ошибка записи в журнал обработки: {e}")
+                batch = []
+
+    def run(self, emails):
+        """
+        Пропускает письма через конвейер и дожидается завершения всех этапов.
+        :param emails: Итерируемые письма. Читаются по мере освобождения места в очереди.
+        :return: Словарь со статистикой прохода.
+        """
+        self.stats = {'messages': 0}
+        self._messages = queue.Queue(self.queue_size)
+        self._attachments = queue.Queue(self.queue_size)
+        self._uploads = queue.Queue(self.queue_size)
+        self._acks = queue.Queue()
+
+        downloaders = self._start(self._download_stage, self.download_workers, 'download')
+        processors = self._start(self._process_stage, self.process_workers, 'process')
+        uploaders = self._start(self._upload_stage, 1, 'upload')
+        acknowledger = self._start(self._ack_stage, 1, 'ack')
+
+        try:
+            for email in emails:
+                if not self._is_due(email):
+                    self._count('messages_deferred')
+                    continue
+                self._count('messages')
+                self._messages.put(MessageJob(email))
+        finally:
+            self._stop(downloaders, self._messages)
+            self._stop(processors, self._attachments)
+            self._stop(uploaders, self._uploads)
+            self._stop(acknowledger, self._acks)
+
+        logger.info(f"Проход завершен: {self.stats}")
+        return self.stats
+
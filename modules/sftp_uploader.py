@@ -0,0 +1,151 @@
+import os
+import posixpath
+import stat
+import time
+
+from loguru import logger
+
+from modules.connection_pool import ConnectionPool
+from modules.metrics import metrics
+from modules.uploader import Uploader
+
+
+class SFTPUploader(Uploader):
+    """
+    Загрузка файлов по SFTP (paramiko). Сессии SSH переиспользуются между файлами, файл передается
+    во временное имя и переименовывается после передачи, поэтому на сервере не бывает недокачанных файлов.
+    """
+
+    def __init__(self, host, username, password=None, port=22, pool_size=2, retries=2, key_filename=None,
+                 known_hosts=None, timeout=30, create_dirs=True):
+        """
+        :param host: Адрес SFTP-сервера.
+        :param username: Имя пользователя.
+        :param password: Пароль (или пароль ключа). None — авторизация только по ключу.
+        :param port: Порт SSH.
+        :param pool_size: Число одновременно открытых SSH-сессий.
+        :param retries: Сколько раз повторять загрузку после обрыва соединения.
+        :param key_filename: Путь к закрытому ключу. None — ключи агента и ~/.ssh.
+        :param known_hosts: Файл известных ключей серверов. Неизвестный ключ сервера — ошибка подключения.
+        None — системный ~/.ssh/known_hosts.
+        :param timeout: Таймаут сетевых операций (в секундах).
+        :param create_dirs: Создавать отсутствующие удаленные каталоги.
+        """
+        super().__init__(parallel=pool_size, create_dirs=create_dirs)
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.retries = retries
+        self.key_filename = key_filename
+        self.known_hosts = known_hosts
+        self.timeout = timeout
+        self.pool = ConnectionPool(self._open, self._is_alive, self._close, size=pool_size)
+
+    @property
+    def login_count(self):
+        """Число выполненных авторизаций на сервере."""
+        return self.pool.login_count
+
+    @property
+    def reuse_count(self):
+        """Число повторных использований уже открытых сессий."""
+        return self.pool.reuse_count
+
+    def _open(self):
+        """
+        Открывает SSH-подключение и SFTP-канал.
+        :return: Кортеж (SSHClient, SFTPClient).
+        """
+        try:
+            import paramiko
+        except ImportError:
+            raise RuntimeError("Для загрузки по SFTP нужен paramiko: pip install -r requirements-sftp.txt")
+
+        logger.info(f"Подключение к SFTP-серверу {self.host}:{self.port}...")
+        client = paramiko.SSHClient()
+        if self.known_hosts:
+            client.load_host_keys(self.known_hosts)
+        else:
+            client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        with metrics.timer('sftp_connect'):
+            client.connect(self.host, port=self.port, username=self.username, password=self.password,
+                           key_filename=self.key_filename, timeout=self.timeout)
+            sftp = client.open_sftp()
+        sftp.get_channel().settimeout(self.timeout)
+        logger.info(f"Успешное подключение к {self.host}")
+        return client, sftp
+
+    @staticmethod
+    def _is_alive(connection, idle):
+        transport = connection[0].get_transport()
+        return transport is not None and transport.is_active()
+
+    @staticmethod
+    def _close(connection):
+        connection[0].close()
+
+    def _make_dirs(self, remote_dir, sftp):
+        """
+        Создает каталог и недостающие родительские каталоги на сервере.
+        """
+        for path in self._path_chain(remote_dir):
+            try:
+                if not stat.S_ISDIR(sftp.stat(path).st_mode):
+                    raise NotADirectoryError(f"На SFTP-сервере {path} — не каталог.")
+            except FileNotFoundError:
+                if not self.create_dirs:
+                    logger.error(f"Удаленный каталог {remote_dir} не найден.")
+                    raise FileNotFoundError(f"Удаленный каталог {remote_dir} не найден.")
+                logger.info(f"Создание каталога {path} на SFTP-сервере...")
+                sftp.mkdir(path)
+
+    def _upload(self, file_path, remote_dir, result):
+        file_name = os.path.basename(file_path)
+        remote_path = posixpath.join(remote_dir, file_name)
+        tmp_path = posixpath.join(remote_dir, f'.{file_name}.part')
+        started = time.monotonic()
+        connection = self.pool.acquire()
+        broken = False
+        try:
+            for attempt in range(self.retries + 1):
+                result['retries'] = attempt
+                sftp = connection[1]
+                try:
+                    self.ensure_dir(remote_dir, sftp)
+                    logger.info(f"Загрузка файла {file_name} в каталог {remote_dir}...")
+                    with metrics.timer('sftp_store'):
+                        attributes = sftp.put(file_path, tmp_path)
+                        sftp.posix_rename(tmp_path, remote_path)
+                    result['bytes'] = attributes.st_size
+                    metrics.add_bytes('sftp_store', attributes.st_size)
+                    logger.info(f"Файл {file_name} успешно загружен.")
+                    result['success'] = True
+                    return
+                except FileNotFoundError:
+                    # Каталог удалили на сервере после проверки: следующая попытка создаст его заново
+                    self.forget_dir(remote_dir)
+                    if attempt == self.retries or not self.create_dirs:
+                        raise
+                except (OSError, EOFError) as e:
+                    # Оборванное подключение не возвращается в пул
+                    broken = True
+                    if attempt == self.retries:
+                        raise
+                    logger.warning(f"Соединение с SFTP-сервером прервано ({e}), повтор {attempt + 1}...")
+                    metrics.count('sftp_retries')
+                    connection = self.pool.reconnect(connection)
+                    broken = False
+        finally:
+            result['duration'] = time.monotonic() - started
+            self.pool.release(connection, broken)
+
+    def disconnect(self):
+        """
+        Закрывает все SSH-сессии.
+        """
+        super().disconnect()
+        self.pool.close_all()
+        logger.info(f"Отключение от SFTP-сервера. Авторизаций: {self.login_count}, "
+                    f"повторных использований сессий: {self.reuse_count}")
@@ -0,0 +1,151 @@
+import os
+import posixpath
+import threading
+from abc import ABC, abstractmethod
+
+from loguru import logger
+
+from modules.metrics import metrics
+from modules.utils import remove_files
+
+# Признак завершения работы для потоков этапа
+STOP = object()
+
+
+class StageRunner(ABC):
+    """
+    Основа многопоточных конвейеров (MailPipeline, FolderIngest): этапы работают в своих потоках
+    и связаны ограниченными очередями, завершаются признаком STOP в очереди этапа.
+    Статистика прохода собирается в stats и дублируется в общий реестр метрик.
+
+    Этап загрузки у конвейеров общий (_upload_stage): подкласс задает uploader, store и очередь _uploads
+    с элементами (файлы, каталог загрузки, sha256 или None, контекст) и учитывает итог в _uploaded.
+    """
+
+    # Префикс имен метрик счетчиков конвейера
+    metrics_prefix = ''
+
+    def __init__(self):
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + value
+        metrics.count(f'{self.metrics_prefix}{key}', value)
+
+    @staticmethod
+    def _start(target, count, name, *args):
+        """
+        Запускает count потоков этапа.
+        :param args: Аргументы target.
+        :return: Список потоков.
+        """
+        threads = [threading.Thread(target=target, args=args, name=f'{name}-{index}', daemon=True)
+                   for index in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _stop(threads, stage_queue):
+        """
+        Передает каждому потоку этапа признак завершения и дожидается, пока они разберут очередь.
+        """
+        for _ in threads:
+            stage_queue.put(STOP)
+        for thread in threads:
+            thread.join()
+
+    def _release(self, sha256):
+        """
+        Снимает резерв содержимого в индексе (ContentStore.release), не прерывая этап при ошибке.
+        """
+        try:
+            self.store.release(sha256)
+        except Exception as e:
+            logger.error(f"Ошибка при снятии резерва индекса содержимого: {e}")
+
+    @abstractmethod
+    def _uploaded(self, context, file_paths, ok, error):
+        """
+        Учитывает итог загрузки элемента (журнал, индекс, подтверждение письма).
+        :param context: Контекст элемента очереди _uploads.
+        :param ok: Все файлы загружены.
+        :param error: Текст последней ошибки загрузки или None.
+        """
+
+    def _finish_upload(self, item, results):
+        """
+        Обрабатывает результаты загрузки файлов одного элемента: статистика, индекс содержимого, _uploaded.
+        """
+        file_paths, remote_dir, sha256, context = item
+        ok = True
+        error = None
+        for result in results:
+            if result['success']:
+                self._count('files_uploaded')
+                self._count('bytes_uploaded', result['bytes'])
+            else:
+                self._count('files_failed')
+                ok = False
+                error = result['error']
+        if sha256 is not None:
+            try:
+                if ok:
+                    remote_path = posixpath.join(remote_dir, os.path.basename(file_paths[0]))
+                    self.store.mark_uploaded(sha256, file_paths[0], remote_path)
+                    # Индекс хранит один локальный файл на исходник: остальные страницы после загрузки не нужны
+                    remove_files(file_paths[1:])
+            except Exception as e:
+                # Файлы загружены: без записи в индексе содержимое будет загружено повторно, но не потеряно
+                logger.error(f"Ошибка при записи в индекс содержимого: {e}")
+            finally:
+                self._release(sha256)
+        self._uploaded(context, file_paths, ok, error)
+
+    def _upload_stage(self):
+        """
+        Ставит файлы на загрузку через асинхронный интерфейс хранилища (Uploader.submit) и сразу берет
+        следующий элемент: передачи идут параллельно в пуле хранилища, а не по потоку конвейера на файл.
+        Одновременно в работе не больше upload_workers элементов, поэтому очередь _uploads сохраняет
+        обратное давление. Итог элемента обрабатывается, когда загружены все его файлы.
+        """
+        slots = threading.BoundedSemaphore(self.upload_workers)
+        while True:
+            item = self._uploads.get()
+            if item is STOP:
+                break
+            slots.acquire()
+            file_paths, remote_dir = item[0], item[1]
+            try:
+                futures = [self.uploader.submit(file_path, remote_dir) for file_path in file_paths]
+            except Exception as e:
+                # Пул хранилища недоступен (например, закрыт): загружаем в этом потоке
+                logger.warning(f"Асинхронная загрузка недоступна ({e}), файлы загружаются последовательно")
+                try:
+                    self._finish_upload(item, [self.uploader.upload_file_safe(file_path, remote_dir)
+                                               for file_path in file_paths])
+                finally:
+                    slots.release()
+                continue
+            pending = [len(futures)]
+            lock = threading.Lock()
+
+            def on_done(_, item=item, futures=futures, pending=pending, lock=lock):
+                with lock:
+                    pending[0] -= 1
+                    if pending[0]:
+                        return
+                try:
+                    self._finish_upload(item, [future.result() for future in futures])
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке результата загрузки: {e}")
+                finally:
+                    slots.release()
+
+            for future in futures:
+                future.add_done_callback(on_done)
+        # Дожидаемся загрузок, поставленных до признака завершения
+        for _ in range(self.upload_workers):
+            slots.acquire()
@@ -2,6 +2,75 @@ import re
 
 from loguru import logger
 
+from modules.metrics import metrics
+
+# Теги, содержимое которых никогда не попадает в текст письма
+SKIPPED_TAGS = {'head', 'style', 'script', 'title', 'noscript'}
+# Блочные теги: после них в тексте ставится перевод строки
+BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'table', 'ul', 'ol', 'hr',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre'}
+# Признаки цитаты (блок с перепиской): class или id элемента
+QUOTE_CLASSES = {'gmail_quote', 'moz-cite-prefix', 'yahoo_quoted'}
+QUOTE_IDS = {'divrplyfwdmsg', 'appendonsend'}
+# Строки-разделители пересылки, которые не считаются собственным текстом письма
+FORWARD_MARKERS = re.compile(r'^\s*(?:-{2,}.*|.*(?:forwarded message|original message|'
+                             r'пересылаемое сообщение|исходное сообщение).*)$', re.IGNORECASE | re.MULTILINE)
+
+
+class _HTMLTextCollector:
+    """
+    Получатель событий потокового HTML-парсера lxml: собирает текст без построения дерева,
+    пропуская style/script и отделяя цитируемую переписку.
+    """
+
+    def __init__(self):
+        self.text = []
+        self.quoted = []
+        self._skip_depth = 0
+        self._quote_depth = 0
+        self._after_reply_header = False
+
+    def _is_quote(self, tag, attrib):
+        if tag == 'blockquote':
+            return True
+        classes = set((attrib.get('class') or '').lower().split())
+        return bool(classes & QUOTE_CLASSES) or (attrib.get('id') or '').lower() in QUOTE_IDS
+
+    def start(self, tag, attrib):
+        if self._skip_depth:
+            self._skip_depth += 1
+            return
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = 1
+            return
+        if self._quote_depth:
+            self._quote_depth += 1
+        elif self._is_quote(tag, attrib):
+            self._quote_depth = 1
+            # Outlook ставит заголовок ответа отдельным блоком, вся переписка идет после него
+            if (attrib.get('id') or '').lower() in QUOTE_IDS:
+                self._after_reply_header = True
+
+    def end(self, tag):
+        if self._skip_depth:
+            self._skip_depth -= 1
+            return
+        if tag in BLOCK_TAGS:
+            self.data('\n')
+        if self._quote_depth:
+            self._quote_depth -= 1
+
+    def data(self, data):
+        if self._skip_depth:
+            return
+        if self._quote_depth or self._after_reply_header:
+            self.quoted.append(data)
+        else:
+            self.text.append(data)
+
+    def close(self):
+        return ''.join(self.text), ''.join(self.quoted)
+
 
 class TextProcessor:
     """
@@ -29,12 +98,47 @@ class TextProcessor:
         r"--\n",  # Пример: текст после "---"
     ]
 
+    # Сколько первых непустых строк проверяется на приветствие
+    GREETING_LINES = 5
+
     def __init__(self):
         """
         Инициализация модуля.
         """
-        self.greetings_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in self.GREETINGS]
-        self.signatures_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in self.SIGNATURES]
+        # Все шаблоны объединены в одно регулярное выражение: подпись ищется за один проход по тексту
+        self.greetings_pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in self.GREETINGS),
+                                            re.IGNORECASE)
+        self.signatures_pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in self.SIGNATURES),
+                                             re.IGNORECASE)
+
+    @staticmethod
+    def html_to_text(html, skip_quotes=True, chunk_size=64 * 1024):
+        """
+        Извлекает текст из HTML-тела письма потоковым парсером lxml, без построения дерева документа.
+        Содержимое style/script пропускается. Цитируемая переписка (blockquote, gmail_quote,
+        заголовок ответа Outlook и все после него) отбрасывается, если кроме нее в письме есть текст.
+        :param html: HTML-тело письма.
+        :param skip_quotes: Отбрасывать цитируемую переписку.
+        :param chunk_size: Размер порции, которой HTML передается парсеру.
+        """
+        if not html:
+            return ""
+
+        from lxml import etree  # импорт при первом письме: запуск без писем не загружает lxml
+
+        with metrics.timer('html_to_text'):
+            parser = etree.HTMLParser(target=_HTMLTextCollector())
+            for offset in range(0, len(html), chunk_size):
+                parser.feed(html[offset:offset + chunk_size])
+            text, quoted = parser.close()
+        metrics.add_bytes('html_to_text', len(html))
+
+        if not skip_quotes:
+            text += quoted
+        elif not FORWARD_MARKERS.sub('', text).strip():
+            # Пересланное письмо без собственного текста: подпись к фото находится в цитате
+            text = FORWARD_MARKERS.sub('', text + quoted)
+        return re.sub(r'\n[ \t\xa0]*(?:\n[ \t\xa0]*)+', '\n\n', text).strip()
 
     def extract_clean_text(self, email_text):
         """
@@ -45,28 +149,32 @@ class TextProcessor:
         if not email_text:
             return ""
 
-        # Разделяем текст построчно
-        lines = email_text.splitlines()
-        cleaned_lines = []
-        logger.info(f'{email_text = }')
-
-        # Удаляем приветствие (первые строки письма)
-        greeting_removed = False
-        for line in lines:
-            if not greeting_removed:
-                # Проверяем, является ли строка приветствием
-                if any(pattern.match(line.strip()) for pattern in self.greetings_patterns):
-                    greeting_removed = True
-                    continue
-            cleaned_lines.append(line)
-
-        # Удаляем подпись (конец письма)
-        cleaned_text = "\n".join(cleaned_lines)
-        for pattern in self.signatures_patterns:
-            cleaned_text = re.split(pattern, cleaned_text, maxsplit=1)[0]
+        logger.debug(f'Длина текста письма: {len(email_text)}')
+        if '\r' in email_text:
+            email_text = '\n'.join(email_text.splitlines())
+
+        # Удаляем приветствие: проверяются только первые непустые строки письма
+        position = 0
+        checked = 0
+        while checked < self.GREETING_LINES and position <= len(email_text):
+            line_end = email_text.find('\n', position)
+            if line_end == -1:
+                line_end = len(email_text)
+            line = email_text[position:line_end].strip()
+            if line:
+                if self.greetings_pattern.match(line):
+                    email_text = email_text[:position] + email_text[line_end + 1:]
+                    break
+                checked += 1
+            position = line_end + 1
+
+        # Удаляем подпись (конец письма): ищется самое раннее вхождение любого шаблона
+        match = self.signatures_pattern.search(email_text)
+        if match:
+            email_text = email_text[:match.start()]
 
         # Очищаем лишние пробелы и переносы строк
-        cleaned_text = cleaned_text.strip()
+        cleaned_text = email_text.strip()
 
         return cleaned_text
 
@@ -0,0 +1,75 @@
+import threading
+import time
+
+from modules.utils import open_sqlite
+
+
+class TransferJournal:
+    """
+    Локальный журнал передачи файлов на сервер. Хранит состояние каждой загрузки,
+    чтобы после сбоя докачивать только недостающие байты.
+    """
+
+    IN_PROGRESS = 'in_progress'
+    DONE = 'done'
+
+    def __init__(self, db_path):
+        """
+        :param db_path: Путь к файлу базы SQLite.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = open_sqlite(db_path)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS transfers (
+                remote_path TEXT PRIMARY KEY,
+                local_path TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                bytes_sent INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+
+    def get(self, remote_path):
+        """
+        Возвращает запись о передаче файла или None.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM transfers WHERE remote_path = ?', (remote_path,)).fetchone()
+        return dict(row) if row else None
+
+    def begin(self, remote_path, local_path, sha256, size, offset=0):
+        """
+        Отмечает начало (или продолжение с offset) передачи файла.
+        """
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (remote_path, local_path, sha256, size, offset, self.IN_PROGRESS, time.time())
+            )
+
+    def progress(self, remote_path, bytes_sent):
+        """
+        Сохраняет число переданных байт.
+        """
+        with self._lock:
+            self._db.execute('UPDATE transfers SET bytes_sent = ?, updated_at = ? WHERE remote_path = ?',
+                             (bytes_sent, time.time(), remote_path))
+
+    def done(self, remote_path, local_path, sha256, size):
+        """
+        Отмечает файл как полностью переданный.
+        """
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (remote_path, local_path, sha256, size, size, self.DONE, time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,44 @@
+import re
+
+from loguru import logger
+
+
+class UploadRouter:
+    """
+    Выбор каталога загрузки по отправителю и теме письма. Правила проверяются по порядку,
+    срабатывает первое подходящее; если ни одно не подошло, используется каталог по умолчанию.
+    """
+
+    def __init__(self, default_dir, routes=()):
+        """
+        :param default_dir: Каталог для писем, не подошедших ни под одно правило.
+        :param routes: Правила — словари с ключами 'remote_dir' и хотя бы одним из 'sender', 'subject'
+        (регулярные выражения, ищутся без учета регистра). Если заданы оба, должны совпасть оба.
+        Пример: {'sender': r'@tass\\.ru$', 'remote_dir': '/PHOTO/INBOX/TASS'}.
+        """
+        self.default_dir = default_dir
+        self.routes = []
+        for route in routes:
+            if not route.get('remote_dir') or not (route.get('sender') or route.get('subject')):
+                raise ValueError(f"Правило загрузки должно содержать remote_dir и sender или subject: {route}")
+            self.routes.append((self._compile(route.get('sender')), self._compile(route.get('subject')),
+                                route['remote_dir']))
+
+    @staticmethod
+    def _compile(pattern):
+        return re.compile(pattern, re.IGNORECASE) if pattern else None
+
+    def route(self, sender=None, subject=None):
+        """
+        :param sender: Адрес отправителя.
+        :param subject: Тема письма.
+        :return: Каталог загрузки.
+        """
+        for sender_pattern, subject_pattern, remote_dir in self.routes:
+            if sender_pattern and not sender_pattern.search(sender or ''):
+                continue
+            if subject_pattern and not subject_pattern.search(subject or ''):
+                continue
+            logger.info(f"Письмо от {sender} загружается в каталог {remote_dir}")
+            return remote_dir
+        return self.default_dir
@@ -0,0 +1,143 @@
+import posixpath
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+
+class Uploader(ABC):
+    """
+    Общий интерфейс хранилищ для загрузки файлов: FTP/FTPS (FTPUploader), SFTP (SFTPUploader)
+    и локальная или сетевая папка (LocalUploader). Подклассы реализуют передачу одного файла (_upload)
+    и создание каталога (_make_dirs), остальное у всех хранилищ общее.
+
+    Загрузка асинхронная: submit сразу возвращает Future, а передачи идут в пуле хранилища,
+    не более parallel одновременно. Каталоги создаются один раз за время работы программы.
+    """
+
+    def __init__(self, parallel=4, create_dirs=True):
+        """
+        :param parallel: Число одновременных передач.
+        :param create_dirs: Создавать отсутствующие удаленные каталоги. False — ошибка загрузки.
+        """
+        self.parallel = parallel
+        self.create_dirs = create_dirs
+        self._dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @staticmethod
+    def _new_result(file_path):
+        return {'file': file_path, 'success': False, 'skipped': False, 'resumed_from': 0,
+                'retries': 0, 'bytes': 0, 'duration': 0.0, 'error': None}
+
+    @abstractmethod
+    def _upload(self, file_path, remote_dir, result):
+        """
+        Передает один файл, по ходу заполняя словарь результата. Ошибки передаются исключениями.
+        """
+
+    @abstractmethod
+    def _make_dirs(self, remote_dir, *args):
+        """
+        Создает удаленный каталог вместе с родительскими.
+        """
+
+    @staticmethod
+    def _path_chain(remote_dir):
+        """
+        Пути каталога и всех его родителей по порядку создания: '/a/b' -> ['/a', '/a/b'].
+        """
+        paths = []
+        path = '/' if remote_dir.startswith('/') else ''
+        for part in remote_dir.strip('/').split('/'):
+            path = posixpath.join(path, part)
+            paths.append(path)
+        return paths
+
+    def ensure_dir(self, remote_dir, *args):
+        """
+        Создает удаленный каталог, если он еще не создан и не проверен за время работы программы.
+        Повторные вызовы для того же каталога не обращаются к хранилищу, одновременные — ждут первый.
+        :param args: Передаются в _make_dirs (например, сессия, через которую создается каталог).
+        """
+        if remote_dir in self._dirs:
+            return
+        with self._dirs_lock:
+            if remote_dir not in self._dirs:
+                self._make_dirs(remote_dir, *args)
+                self._dirs.add(remote_dir)
+
+    def forget_dir(self, remote_dir):
+        """
+        Убирает каталог из кэша созданных (например, если его удалили в хранилище).
+        """
+        with self._dirs_lock:
+            self._dirs.discard(remote_dir)
+
+    def connect(self):
+        """
+        Проверяет доступность хранилища. По умолчанию подключение откладывается до первой передачи.
+        """
+
+    def upload_file_safe(self, file_path, remote_dir):
+        """
+        Загружает файл в хранилище, не выбрасывая исключений: ошибка возвращается в результате.
+        :param file_path: Локальный путь к файлу.
+        :param remote_dir: Каталог в хранилище.
+        :return: Словарь с результатом: file, success, skipped, resumed_from, retries, bytes, duration, error.
+        """
+        result = self._new_result(file_path)
+        try:
+            self._upload(file_path, remote_dir, result)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке файла {file_path}: {e}")
+            result['error'] = str(e)
+        return result
+
+    def submit(self, file_path, remote_dir):
+        """
+        Ставит файл в очередь на загрузку и сразу возвращает управление.
+        :return: Future со словарем результата (см. upload_file_safe). Ошибки возвращаются в результате.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=max(1, self.parallel),
+                                                    thread_name_prefix=f'{type(self).__name__}-upload')
+        return self._executor.submit(self.upload_file_safe, file_path, remote_dir)
+
+    def upload_files(self, file_paths, remote_dir="/", parallel=1):
+        """
+        Загружает список файлов.
+        :param file_paths: Локальные пути к файлам. Может быть генератором: загрузка каждого файла
+        начинается, как только он получен, не дожидаясь остальных.
+        :param remote_dir: Каталог в хранилище.
+        :param parallel: Число одновременных загрузок. Не больше parallel, заданного в конструкторе.
+        :return: Список результатов по каждому файлу в порядке file_paths (см. upload_file_safe).
+        """
+        workers = max(1, min(parallel, self.parallel))
+
+        if workers == 1:
+            results = [self.upload_file_safe(file_path, remote_dir) for file_path in file_paths]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload') as executor:
+                futures = [executor.submit(self.upload_file_safe, file_path, remote_dir)
+                           for file_path in file_paths]
+                results = [future.result() for future in futures]
+
+        uploaded = [result for result in results if result['success']]
+        if len(results) > 1:
+            logger.info(f"Загружено файлов: {len(uploaded)} из {len(results)}, "
+                        f"{sum(result['bytes'] for result in uploaded)} байт")
+        return results
+
+    def disconnect(self):
+        """
+        Дожидается поставленных загрузок и закрывает подключения.
+        """
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import sqlite3
+
+
+def open_sqlite(db_path):
+    """
+    Открывает базу SQLite для локального состояния программы (журналы, индексы).
+    Каталог базы создается при необходимости, включается режим WAL.
+    :param db_path: Путь к файлу базы.
+    :return: Подключение sqlite3, которое можно использовать из нескольких потоков под общей блокировкой.
+    """
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """
+    Считает SHA-256 файла, читая его блоками.
+    :param file_path: Путь к файлу.
+    :param chunk_size: Размер блока чтения в байтах.
+    :return: Хэш в шестнадцатеричном виде.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def shorten(text, limit=80):
+    """
+    Сокращает текст для записи в лог: одна строка не длиннее limit символов.
+    """
+    text = ' '.join(str(text).split())
+    return text if len(text) <= limit else f"{text[:limit - 1]}…"
+
+
+def remove_files(file_paths):
+    """
+    Удаляет файлы, пропуская уже удаленные.
+    """
+    for file_path in file_paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
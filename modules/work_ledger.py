@@ -0,0 +1,178 @@
+import json
+import threading
+import time
+
+from modules.utils import open_sqlite
+
+
+class WorkLedger:
+    """
+    Журнал обработки писем и вложений (по ItemId письма и AttachmentId вложения). Каждый завершенный этап
+    записывается сразу, поэтому после сбоя работа продолжается с последнего завершенного этапа:
+    загруженные вложения не скачиваются и не загружаются повторно, обработанные — только загружаются.
+    Письмо с ошибкой повторяется не раньше, чем через экспоненциально растущую паузу.
+    """
+
+    # Этапы письма
+    STARTED = 'started'
+    UPLOADED = 'uploaded'  # все вложения загружены, письмо еще не отмечено прочитанным
+    DONE = 'done'
+
+    # Этапы вложения
+    PROCESSED = 'processed'  # JPEG готов на диске, но не загружен
+    SKIPPED = 'skipped'  # не изображение
+    FAILED = 'failed'
+    # UPLOADED — загружено (или уже было загружено из другого письма)
+
+    def __init__(self, db_path, retry_base=60, retry_max=3600):
+        """
+        :param db_path: Путь к файлу базы SQLite.
+        :param retry_base: Пауза перед первым повтором письма с ошибкой (в секундах), дальше удваивается.
+        :param retry_max: Максимальная пауза между повторами (в секундах).
+        """
+        self.db_path = db_path
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = threading.Lock()
+        self._db = open_sqlite(db_path)
+        # Запись этапа должна пережить не только падение программы, но и отключение питания
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                item_id TEXT PRIMARY KEY,
+                subject TEXT,
+                stage TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS attachments (
+                item_id TEXT NOT NULL,
+                attachment_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                sha256 TEXT,
+                files TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (item_id, attachment_id)
+            );
+            CREATE INDEX IF NOT EXISTS messages_updated ON messages (stage, updated_at);
+            """
+        )
+
+    def is_due(self, item_id):
+        """
+        Проверяет, можно ли обрабатывать письмо сейчас (не ждет ли оно паузы после ошибки).
+        """
+        with self._lock:
+            row = self._db.execute('SELECT next_attempt_at FROM messages WHERE item_id = ?', (item_id,)).fetchone()
+        return row is None or row['next_attempt_at'] <= time.time()
+
+    def begin_message(self, item_id, subject):
+        """
+        Заводит запись о письме при первой обработке.
+        """
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO messages (item_id, subject, stage, updated_at) VALUES (?, ?, ?, ?)',
+                             (item_id, subject, self.STARTED, time.time()))
+
+    def attachments(self, item_id):
+        """
+        Возвращает сохраненные этапы вложений письма.
+        :return: Словарь {attachment_id: запись}; в поле files — список (путь, размер, mtime_ns) или None.
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM attachments WHERE item_id = ?', (item_id,)).fetchall()
+        entries = {}
+        for row in rows:
+            entry = dict(row)
+            entry['files'] = json.loads(entry['files']) if entry['files'] else None
+            entries[row['attachment_id']] = entry
+        return entries
+
+    def _set_attachment(self, item_id, attachment_id, name, stage, sha256=None, files=None, error=None):
+        with self._lock:
+            self._db.execute(
+                """
+                INSERT INTO attachments (item_id, attachment_id, name, stage, sha256, files, attempts, last_error,
+                                         updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (item_id, attachment_id) DO UPDATE SET
+                    name = excluded.name, stage = excluded.stage,
+                    sha256 = COALESCE(excluded.sha256, sha256), files = COALESCE(excluded.files, files),
+                    attempts = attempts + excluded.attempts, last_error = excluded.last_error,
+                    updated_at = excluded.updated_at
+                """,
+                (item_id, attachment_id, name, stage, sha256, json.dumps(files) if files is not None else None,
+                 1 if stage == self.FAILED else 0, error, time.time())
+            )
+
+    def attachment_processed(self, item_id, attachment_id, name, sha256, files):
+        """
+        Отмечает, что вложение обработано.
+        :param files: Итоговые JPEG — список (путь, размер, mtime_ns) для проверки при возобновлении.
+        """
+        self._set_attachment(item_id, attachment_id, name, self.PROCESSED, sha256, files)
+
+    def attachment_uploaded(self, item_id, attachment_id, name, sha256=None):
+        self._set_attachment(item_id, attachment_id, name, self.UPLOADED, sha256)
+
+    def attachment_skipped(self, item_id, attachment_id, name):
+        self._set_attachment(item_id, attachment_id, name, self.SKIPPED)
+
+    def attachment_failed(self, item_id, attachment_id, name, error):
+        self._set_attachment(item_id, attachment_id, name, self.FAILED, error=str(error))
+
+    def message_uploaded(self, item_id):
+        """
+        Отмечает, что все вложения письма загружены.
+        """
+        with self._lock:
+            self._db.execute('UPDATE messages SET stage = ?, next_attempt_at = 0, last_error = NULL, updated_at = ? '
+                             'WHERE item_id = ?', (self.UPLOADED, time.time(), item_id))
+
+    def message_failed(self, item_id, error):
+        """
+        Отмечает ошибку обработки письма и назначает время следующей попытки.
+        :return: Пауза до следующей попытки (в секундах).
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT attempts FROM messages WHERE item_id = ?', (item_id,)).fetchone()
+            attempts = (row['attempts'] if row else 0) + 1
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            self._db.execute('UPDATE messages SET stage = ?, attempts = ?, next_attempt_at = ?, last_error = ?, '
+                             'updated_at = ? WHERE item_id = ?',
+                             (self.STARTED, attempts, now + delay, str(error), now, item_id))
+        return delay
+
+    def message_done(self, item_ids):
+        """
+        Отмечает письма как полностью обработанные (отмеченные прочитанными).
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany('UPDATE messages SET stage = ?, updated_at = ? WHERE item_id = ?',
+                                 [(self.DONE, now, item_id) for item_id in item_ids])
+
+    def prune(self, max_age):
+        """
+        Удаляет записи о полностью обработанных письмах старше max_age секунд.
+        :return: Число удаленных писем.
+        """
+        cutoff = time.time() - max_age
+        with self._lock:
+            # Сначала вложения: при сбое между запросами письмо останется и будет удалено в следующий раз
+            self._db.execute('DELETE FROM attachments WHERE item_id IN '
+                             '(SELECT item_id FROM messages WHERE stage = ? AND updated_at < ?)', (self.DONE, cutoff))
+            removed = self._db.execute('DELETE FROM messages WHERE stage = ? AND updated_at < ?',
+                                       (self.DONE, cutoff)).rowcount
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
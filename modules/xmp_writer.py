@@ -0,0 +1,170 @@
+import io
+import os
+import re
+import shutil
+import struct
+import tempfile
+from html import escape
+
+XMP_NAMESPACE = b'http://ns.adobe.com/xap/1.0/\x00'
+XMP_EXTENSION_NAMESPACE = b'http://ns.adobe.com/xmp/extension/\x00'
+MAX_PACKET_SIZE = 0xFFFF - 2 - len(XMP_NAMESPACE)
+
+SOI = b'\xff\xd8'
+SOS = 0xDA
+EOI = 0xD9
+APP0 = 0xE0
+APP1 = 0xE1
+# Маркеры без поля длины: TEM и RST0-RST7
+STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+
+# Символы, недопустимые в XML 1.0
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+_PACKET_TEMPLATE = (
+    '<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+    ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+    '  <rdf:Description rdf:about=""\n'
+    '    xmlns:xmp="http://ns.adobe.com/xap/1.0/"\n'
+    '    xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+    '   <xmp:Label>{label}</xmp:Label>\n'
+    '   <dc:description>\n'
+    '    <rdf:Alt>\n'
+    '     <rdf:li xml:lang="x-default">{description}</rdf:li>\n'
+    '    </rdf:Alt>\n'
+    '   </dc:description>\n'
+    '  </rdf:Description>\n'
+    ' </rdf:RDF>\n'
+    '</x:xmpmeta>\n'
+    '{padding}'
+    '<?xpacket end="w"?>'
+)
+
+
+class XMPWriteError(Exception):
+    """
+    Файл нельзя обработать встроенным писателем XMP (нужен exiftool).
+    """
+
+
+def _xml_text(value):
+    # html.escape вместо xml.sax.saxutils: тот же результат без импорта urllib при запуске
+    return escape(_INVALID_XML_CHARS.sub('', str(value)), quote=False)
+
+
+def build_xmp_packet(label, description, padding=2048):
+    """
+    Собирает XMP-пакет с полями xmp:Label и dc:description.
+    :param label: Цветовая метка.
+    :param description: Описание изображения.
+    :param padding: Число пробелов запаса, чтобы другие программы могли дописать пакет на месте.
+    :return: Пакет в кодировке UTF-8.
+    """
+    packet = _PACKET_TEMPLATE.format(label=_xml_text(label), description=_xml_text(description),
+                                     padding=(' ' * 99 + '\n') * (padding // 100))
+    return packet.encode('utf-8')
+
+
+def _read_header_segments(file):
+    """
+    Читает сегменты JPEG до начала сжатых данных (SOS), не затрагивая сами данные изображения.
+    :return: Список кортежей (маркер, байты сегмента целиком) и байты маркера, на котором чтение остановилось.
+    """
+    if file.read(2) != SOI:
+        raise XMPWriteError('Файл не является JPEG')
+
+    segments = []
+    while True:
+        byte = file.read(1)
+        if byte != b'\xff':
+            raise XMPWriteError('Поврежденная структура JPEG')
+        marker = file.read(1)
+        while marker == b'\xff':  # байты-заполнители
+            marker = file.read(1)
+        if not marker:
+            raise XMPWriteError('Неожиданный конец файла JPEG')
+
+        code = marker[0]
+        if code in (SOS, EOI):
+            return segments, b'\xff' + marker
+        if code in STANDALONE_MARKERS:
+            segments.append((code, b'\xff' + marker))
+            continue
+
+        length_bytes = file.read(2)
+        if len(length_bytes) != 2:
+            raise XMPWriteError('Неожиданный конец файла JPEG')
+        (length,) = struct.unpack('>H', length_bytes)
+        payload = file.read(length - 2)
+        if len(payload) != length - 2:
+            raise XMPWriteError('Неожиданный конец файла JPEG')
+        segments.append((code, b'\xff' + marker + length_bytes + payload))
+
+
+def _xmp_segment(label, description):
+    packet = build_xmp_packet(label, description)
+    if len(packet) > MAX_PACKET_SIZE:
+        packet = build_xmp_packet(label, description, padding=0)
+        if len(packet) > MAX_PACKET_SIZE:
+            raise XMPWriteError('XMP-пакет не помещается в один сегмент APP1')
+    return b'\xff\xe1' + struct.pack('>H', len(packet) + len(XMP_NAMESPACE) + 2) + XMP_NAMESPACE + packet
+
+
+def _splice(src, dst, xmp_segment):
+    """
+    Копирует JPEG из src в dst, вставляя сегмент XMP после ведущих APP0 (JFIF) и APP1 (EXIF).
+    Сжатые данные изображения копируются побайтно.
+    """
+    segments, stop_marker = _read_header_segments(src)
+    for code, data in segments:
+        if code == APP1 and (data[4:4 + len(XMP_NAMESPACE)] == XMP_NAMESPACE
+                             or data[4:4 + len(XMP_EXTENSION_NAMESPACE)] == XMP_EXTENSION_NAMESPACE):
+            raise XMPWriteError('В файле уже есть XMP')
+
+    insert_at = 0
+    while insert_at < len(segments) and segments[insert_at][0] in (APP0, APP1):
+        insert_at += 1
+
+    dst.write(SOI)
+    for _, data in segments[:insert_at]:
+        dst.write(data)
+    dst.write(xmp_segment)
+    for _, data in segments[insert_at:]:
+        dst.write(data)
+    dst.write(stop_marker)
+    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def inject_jpeg_xmp(data, label, description):
+    """
+    Возвращает копию JPEG (bytes) с добавленным XMP-пакетом, не декодируя изображение.
+    :raises XMPWriteError: Если файл нужно обработать через exiftool.
+    """
+    dst = io.BytesIO()
+    _splice(io.BytesIO(data), dst, _xmp_segment(label, description))
+    return dst.getvalue()
+
+
+def write_jpeg_xmp(file_path, label, description):
+    """
+    Записывает XMP-пакет в JPEG без декодирования изображения: сегмент APP1 вставляется
+    после APP0/EXIF, сжатые данные копируются побайтно. Файл заменяется атомарно.
+    Файлы, в которых уже есть XMP, не обрабатываются, чтобы не потерять чужие поля.
+    :param file_path: Путь к файлу JPEG.
+    :param label: Цветовая метка (xmp:Label).
+    :param description: Описание (dc:description).
+    :raises XMPWriteError: Если файл нужно обработать через exiftool.
+    """
+    xmp_segment = _xmp_segment(label, description)
+    directory = os.path.dirname(os.path.abspath(file_path))
+    with open(file_path, 'rb') as src:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                _splice(src, dst, xmp_segment)
+            shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise